@@ -26,10 +26,15 @@ class Cache():
 		self.counter = itertools.count()
 		self.msgs = {} # dict(msid -> CachedMessage)
 		self.idmap = {} # dict(uid -> dict(msid -> opaque))
+		self.recipients = {} # dict(msid -> dict(uid -> opaque)), reverse of idmap
+		self.deleted = set() # msids of deleted messages, until they expire
 	def _saveMapping(self, x, uid, msid, data):
 		if uid not in x.keys():
 			x[uid] = {}
 		x[uid][msid] = data
+		if msid not in self.recipients.keys():
+			self.recipients[msid] = {}
+		self.recipients[msid][uid] = data
 	def _lookupMapping(self, x, uid, msid, data):
 		if uid not in x.keys():
 			return None
@@ -50,23 +55,48 @@ class Cache():
 	def getMessage(self, msid):
 		with self.lock:
 			return self.msgs.get(msid, None)
+	# returns False (and saves nothing) if the message was deleted
 	def saveMapping(self, uid, msid, data):
 		with self.lock:
+			if msid in self.deleted:
+				return False
 			self._saveMapping(self.idmap, uid, msid, data)
+			return True
 	def lookupMapping(self, uid, msid=None, data=None):
 		if msid is None and data is None:
 			raise ValueError()
 		with self.lock:
 			return self._lookupMapping(self.idmap, uid, msid, data)
+	def getRecipients(self, msid):
+		with self.lock:
+			return dict(self.recipients.get(msid, {}))
 	def deleteMappings(self, msid):
 		with self.lock:
-			for d in self.idmap.values():
-				d.pop(msid, None)
+			for uid in self.recipients.pop(msid, {}).keys():
+				self.idmap[uid].pop(msid, None)
+	# mark message as deleted and drop its mappings, returns the dropped
+	# mappings as dict(uid -> opaque)
+	def markDeleted(self, msid):
+		with self.lock:
+			if msid in self.msgs.keys():
+				self.deleted.add(msid)
+			ret = self.recipients.get(msid, {})
+			self.deleteMappings(msid)
+			return ret
+	# drop the stub mappings (-1) of messages by `uid` that weren't delivered
+	# yet, so that pending sends of them turn into no-ops
+	def dropUndelivered(self, uid):
+		with self.lock:
+			for msid in list(self._allMappings(self.msgs, uid)):
+				x = self.recipients.get(msid, {})
+				for rid in [rid for rid, data in x.items() if data == -1]:
+					del x[rid]
+					self.idmap[rid].pop(msid, None)
 	def allMappings(self, uid):
 		if uid is None:
 			raise ValueError()
 		with self.lock:
-			return self._allMappings(self.msgs, uid)
+			return list(self._allMappings(self.msgs, uid))
 	def expire(self):
 		ids = set()
 		with self.lock:
@@ -77,6 +107,7 @@ class Cache():
 				# delete message itself and from mappings
 				del self.msgs[msid]
 				self.deleteMappings(msid)
+				self.deleted.discard(msid)
 		if len(ids) > 0:
 			logging.debug("Expired %d entries from cache", len(ids))
 		return ids
@@ -1,18 +1,25 @@
 import logging
 import re
+import time
 from datetime import datetime, timedelta
-from threading import Lock
+from threading import Lock, Thread
 
 import src.replies as rp
 from src.globals import *
 from src.database import User, SystemConfig
 from src.cache import CachedMessage
-from src.util import genTripcode
+from src.util import genTripcode, Metrics, TTLMap
+
+# bumped whenever a data migration is added to migrate(), cf. SystemConfig
+MIGRATION_VERSION = 1
 
 db = None # SQLiteDatabase
 ch = None # Cache
 spam_scores = None
-tripcode_last_used = {} # uid -> datetime
+karma_ledger = None
+duplicates = None # DuplicateFilter
+tripcode_last_used = None # TTLMap: uid -> datetime
+metrics = Metrics()
 
 bot_name = None
 log_channel = None
@@ -26,10 +33,14 @@ tripcode_interval = None
 tripcode_toggle = None
 
 def init(config, _db, _ch):
-	global db, ch, bot_name, spam_scores, log_channel, whitelist, lockdown, blacklist_contact, enable_expose, allow_remove_command, media_limit_period, tripcode_interval, tripcode_toggle
+	global db, ch, bot_name, spam_scores, karma_ledger, duplicates, tripcode_last_used, log_channel, whitelist, lockdown, blacklist_contact, enable_expose, allow_remove_command, media_limit_period, tripcode_interval, tripcode_toggle
 	db = _db
 	ch = _ch
 	spam_scores = ScoreKeeper()
+	karma_ledger = KarmaLedger()
+	if config.get("duplicate_filter"):
+		d = config["duplicate_filter"]
+		duplicates = DuplicateFilter(int(d.get("limit", 3)), float(d.get("window", 60)))
 
 	log_channel = config.get("log_channel", False)
 	if log_channel:
@@ -43,6 +54,9 @@ def init(config, _db, _ch):
 	if "media_limit_period" in config.keys():
 		media_limit_period = timedelta(hours=int(config["media_limit_period"]))
 	tripcode_interval = timedelta(hours=float(config.get("tripcode_limit_interval", 0)))
+	tripcode_last_used = TTLMap(max(tripcode_interval.total_seconds(), 1), 100000,
+		"tripcode_cooldown", metrics)
+	metrics.gauge("tripcode_cooldown_size", lambda: len(tripcode_last_used))
 	tripcode_toggle = config.get("tripcode_toggle",False)
 
 	if config.get("locale"):
@@ -55,19 +69,35 @@ def init(config, _db, _ch):
 		c.defaults()
 		db.setSystemConfig(c)
 
-	# update users for new Tripcode DB
-	for user in db.iterateUsers():
-		if not user.tripcode or user.tripname:
-			continue
-		tripname, triphash = genTripcode(user.tripcode, user.salt)
-		with db.modifyUser(id=user.id) as user:
-			user.tripname = tripname
-			user.triphash = triphash
-			
+	if db.getSystemConfig().migrationVersion < MIGRATION_VERSION:
+		t = Thread(target=migrate)
+		t.daemon = True
+		t.start()
+
+# runs pending data migrations once, in the background
+def migrate():
+	version = db.getSystemConfig().migrationVersion
+	if version < 1:
+		# update users for new Tripcode DB
+		rows = []
+		for user in db.iterateUsersWithoutTripname():
+			tripname, triphash = genTripcode(user.tripcode, user.salt)
+			rows.append((user.id, user.tripcode, tripname, triphash))
+		db.setTripnames(rows)
+		logging.info("Derived tripnames for %d users", len(rows))
+	with db.modifySystemConfig() as config:
+		config.migrationVersion = MIGRATION_VERSION
+
 
 def register_tasks(sched):
 	# spam score handling
-	sched.register(spam_scores.scheduledTask, seconds=SPAM_INTERVAL_SECONDS)
+	sched.register(spam_scores.scheduledTask, "spam_sweep", minutes=1)
+	# karma and upvotes
+	sched.register(karma_ledger.flush, "karma_flush", seconds=5)
+	def task():
+		# upvotes are useless once the message has left the cache, cf. CachedMessage
+		db.expireUpvotes(datetime.now() - timedelta(hours=36))
+	sched.register(task, "upvote_expiry", hours=1)
 	# warning removal
 	def task():
 		now = datetime.now()
@@ -77,7 +107,7 @@ def register_tasks(sched):
 			if user.warnExpiry is not None and now >= user.warnExpiry:
 				with db.modifyUser(id=user.id) as user:
 					user.removeWarning()
-	sched.register(task, minutes=15)
+	sched.register(task, "warn_expiry", jitter=30, minutes=15)
 
 def updateUserFromEvent(user, c_user):
 	user.username = c_user.username
@@ -169,29 +199,82 @@ def requireRank(need_rank):
 ###
 
 # RAM cache for spam scores
+# scores are stored as (value, last update) and decay by 1 every
+# SPAM_INTERVAL_SECONDS when read, the scheduled task only evicts idle entries
 
 class ScoreKeeper():
-	def __init__(self):
-		self.lock = Lock()
-		self.scores = {}
+	def __init__(self, shards=16):
+		self.locks = [Lock() for i in range(shards)]
+		self.scores = [{} for i in range(shards)] # uid -> (score, monotonic time)
+	def _shard(self, uid):
+		i = uid % len(self.locks)
+		return self.locks[i], self.scores[i]
+	@staticmethod
+	def _decayed(entry, now):
+		s, t = entry
+		return max(s - (now - t) / SPAM_INTERVAL_SECONDS, 0)
 	def increaseSpamScore(self, uid, n):
-		with self.lock:
-			s = self.scores.get(uid, 0)
+		now = time.monotonic()
+		lock, scores = self._shard(uid)
+		with lock:
+			entry = scores.get(uid)
+			s = 0 if entry is None else self._decayed(entry, now)
 			if s > SPAM_LIMIT:
 				return False
 			elif s + n > SPAM_LIMIT:
-				self.scores[uid] = SPAM_LIMIT_HIT
+				scores[uid] = (SPAM_LIMIT_HIT, now)
 				return s + n <= SPAM_LIMIT_HIT
-			self.scores[uid] = s + n
+			scores[uid] = (s + n, now)
 			return True
 	def scheduledTask(self):
+		now = time.monotonic()
+		for lock, scores in zip(self.locks, self.scores):
+			with lock:
+				for uid in [uid for uid, entry in scores.items() if self._decayed(entry, now) == 0]:
+					del scores[uid]
+
+# RAM buffer for karma changes and upvotes, written to the db in batches
+
+class KarmaLedger():
+	def __init__(self):
+		self.lock = Lock()
+		self.deltas = {} # uid -> karma change not written yet
+		self.upvotes = [] # (user_id, message_id, voter, time) not written yet
+	def add(self, uid, n, upvote=None):
 		with self.lock:
-			for uid in list(self.scores.keys()):
-				s = self.scores[uid] - 1
-				if s <= 0:
-					del self.scores[uid]
-				else:
-					self.scores[uid] = s
+			self.deltas[uid] = self.deltas.get(uid, 0) + n
+			if upvote is not None:
+				self.upvotes.append(upvote)
+	def pending(self, uid):
+		with self.lock:
+			return self.deltas.get(uid, 0)
+	def flush(self):
+		with self.lock:
+			if len(self.deltas) == 0 and len(self.upvotes) == 0:
+				return
+			with db.lock:
+				db.addKarma(self.deltas)
+				db.addUpvotes(self.upvotes)
+			self.deltas = {}
+			self.upvotes = []
+
+# RAM cache of recently relayed content, so that floods of the same message
+# (from one or several users) are stopped before they are relayed
+
+class DuplicateFilter():
+	def __init__(self, limit, window):
+		self.lock = Lock()
+		self.limit = limit
+		self.seen = TTLMap(window, 10000) # fingerprint -> copies relayed
+	# returns whether content with `fingerprint` may be relayed, i.e. it was
+	# relayed less than `limit` times with less than `window` seconds between copies
+	def check(self, fingerprint):
+		with self.lock:
+			n = self.seen.get(fingerprint, 0)
+			if n >= self.limit:
+				return False
+			self.seen[fingerprint] = n + 1
+			return True
 
 ###
 
@@ -205,6 +288,9 @@ class Receiver():
 	def delete(msid):
 		raise NotImplementedError()
 	@staticmethod
+	def delete_bulk(msids, who):
+		raise NotImplementedError()
+	@staticmethod
 	def stop_invoked(who, delete_out):
 		raise NotImplementedError()
 
@@ -212,17 +298,22 @@ class Sender(Receiver): # flawless class hierachy I know...
 	receivers = []
 	@staticmethod
 	def reply(m, msid, who, except_who, reply_to):
-		logging.debug("reply(m.type=%s, msid=%r, reply_to=%r)", rp.types.reverse[m.type], msid, reply_to)
+		logging.debug("reply", extra={"type": rp.types.reverse[m.type], "msid": msid, "reply_to": reply_to})
 		for r in Sender.receivers:
 			r.reply(m, msid, who, except_who, reply_to)
 	@staticmethod
-	def delete(msid, user_id=None):
-		logging.debug("delete(msid=%d)", msid)
+	def delete(msid):
+		logging.debug("delete", extra={"msid": msid})
 		for r in Sender.receivers:
-			r.delete(msid, user_id)
+			r.delete(msid)
+	@staticmethod
+	def delete_bulk(msids, who=None):
+		logging.debug("delete_bulk", extra={"count": len(msids)})
+		for r in Sender.receivers:
+			r.delete_bulk(msids, who)
 	@staticmethod
 	def stop_invoked(who, delete_out=False):
-		logging.debug("stop_invoked(who=%s)", who)
+		logging.debug("stop_invoked", extra={"uid": who.id, "delete_out": delete_out})
 		for r in Sender.receivers:
 			r.stop_invoked(who, delete_out)
 
@@ -363,7 +454,7 @@ def get_info(user):
 		"username": (user.tripname or "anonymous") + (user.triphash or ""),
 		"rank_i": user.rank,
 		"rank": RANKS.reverse[user.rank],
-		"karma": user.karma,
+		"karma": user.karma + karma_ledger.pending(user.id),
 		"warnings": user.warnings,
 		"warnExpiry": user.warnExpiry,
 		"cooldown": user.cooldownUntil if user.isInCooldown() else None,
@@ -387,7 +478,7 @@ def get_info_mod(user, username):
 		"username":  (user2.tripname or "anonymous") + (user2.triphash or ""),
 		"rank_i": user2.rank,
 		"rank": RANKS.reverse[user2.rank],
-		"karma": str(user2.karma),
+		"karma": str(user2.karma + karma_ledger.pending(user2.id)),
 		"cooldown": user2.cooldownUntil if user2.isInCooldown() else None,
 		"muzzled": user2.muzzled,
 	}
@@ -420,6 +511,11 @@ def get_users(user):
 		active=active, inactive=inactive, blacklisted=black,
 		total=active + inactive + black)
 
+@requireUser
+@requireRank(RANKS.admin)
+def get_stats(user):
+	return rp.Reply(rp.types.STATS_INFO, stats=metrics.snapshot())
+
 @requireUser
 def get_help(user):
 	help = db.getSystemConfig().help
@@ -484,7 +580,7 @@ def set_tripcode(user, text):
 		return rp.Reply(rp.types.TRIPCODE_SET, tripname="None", triphash="")
 
 	if tripcode_interval.total_seconds() > 1:
-		last_used = tripcode_last_used.get(user.id, None)
+		last_used = tripcode_last_used.get(user.id)
 		if last_used and (datetime.now() - last_used) < tripcode_interval:
 			diff = str(tripcode_interval - (datetime.now() - last_used)+timedelta(minutes=1))
 			diff = diff[:diff.rfind(":")]
@@ -573,7 +669,7 @@ def warn_user(user, msid, delete=False, text="media"):
 					return rp.Reply(rp.types.ERR_ALREADY_WARNED)
 			logging.info("%s warned %s%s", user, user2, delete and "\nDeleted: " + text)
 	if delete:
-		Sender.delete(msid, user.id)
+		Sender.delete(msid)
 		if user2 is not None:
 			messages.append(get_info_mod(user, user2.id))
 
@@ -588,7 +684,7 @@ def delete_message(user, msid, warn=True, text="media"):
 
 	cm = ch.getMessage(msid)
 
-	Sender.delete(msid, user.id)
+	Sender.delete(msid)
 
 	if cm is None:
 		return rp.Reply(rp.types.ERR_NOT_IN_CACHE)
@@ -743,7 +839,7 @@ def blacklist_user(user, username, reason, msid=None, text=""):
 		db.addBlacklistedUser(user2.id)
 	logging.info("%s was blacklisted by %s for: %s", user2, user, reason)
 	if msid is not None:
-		Sender.delete(msid, user.id)
+		Sender.delete(msid)
 		logging.info("Deleted: %s", text)
 		if user2 is not None:
 			return get_info_mod(user, user2.id)
@@ -865,8 +961,8 @@ def cleanup_user(user, username):
 	if user2.rank > RANKS.banned:
 		return rp.Reply(rp.types.CUSTOM, text="<i>That user has not been banned.</i>")
 
-	for msid in ch.allMappings(user2.id):
-		Sender.delete(msid, user.id)
+	# progress is reported to the moderator while the deletions go out
+	Sender.delete_bulk(list(ch.allMappings(user2.id)), user)
 
 	logging.info("The posts of %s were cleaned up by %s", user2, user)
 	return rp.Reply(rp.types.SUCCESS)
@@ -879,8 +975,15 @@ def give_karma(user, msid):
 	if cm is None or cm.user_id is None:
 		return rp.Reply(rp.types.ERR_NOT_IN_CACHE)
 
+	# upvotes from before a restart are only known to the database
+	message_id = ch.lookupMapping(cm.user_id, msid=msid)
+	if message_id == -1:
+		message_id = None
 	if cm.hasUpvoted(user):
 		return rp.Reply(rp.types.ERR_ALREADY_UPVOTED)
+	if message_id is not None and db.hasUpvoted(cm.user_id, message_id, user.id):
+		cm.addUpvote(user)
+		return rp.Reply(rp.types.ERR_ALREADY_UPVOTED)
 	if user.id == cm.user_id:
 		return rp.Reply(rp.types.ERR_UPVOTE_OWN_MESSAGE)
 
@@ -892,8 +995,10 @@ def give_karma(user, msid):
 		return rp.Reply(rp.types.CUSTOM, text="<i>This message has been locked by mods.</i>")
 	if not user2.muzzled and not user.muzzled:
 		cm.addUpvote(user)
-		with db.modifyUser(id=cm.user_id) as user2:
-			user2.karma += KARMA_PLUS_ONE
+		upvote = None
+		if message_id is not None:
+			upvote = (cm.user_id, message_id, user.id, datetime.now())
+		karma_ledger.add(cm.user_id, KARMA_PLUS_ONE, upvote)
 		if not user2.hideKarma and not user2.left:
 			_push_system_message(rp.Reply(rp.types.KARMA_NOTIFICATION), who=user2, reply_to=msid)
 
@@ -925,6 +1030,8 @@ def reset_karma(user, username):
 	if isTooSensitive(username, user):
 		return rp.Reply(rp.types.ERR_ADMIN_SEARCH)
 
+	karma_ledger.flush() # so that no pending +1 lands after the reset
+
 	user2 = getUserByName(username)
 	if user2 == -1:
 		return rp.Reply(rp.types.ERR_COLLISION)
@@ -1071,7 +1178,7 @@ def expose_to_user(user, msid, username):
 	return rp.Reply(rp.types.EXPOSED)
 
 @requireUser
-def prepare_user_message(user: User, msg_score, *, is_media=False, expose=False, tripcode=False):
+def prepare_user_message(user: User, msg_score, *, is_media=False, expose=False, tripcode=False, fingerprint=None):
 	# prerequisites
 	if user.isInCooldown():
 		return rp.Reply(rp.types.ERR_COOLDOWN, until=user.cooldownUntil)
@@ -1086,6 +1193,10 @@ def prepare_user_message(user: User, msg_score, *, is_media=False, expose=False,
 	ok = spam_scores.increaseSpamScore(user.id, msg_score)
 	if not ok:
 		return rp.Reply(rp.types.ERR_SPAMMY)
+	if fingerprint is not None and duplicates is not None and user.rank < RANKS.mod:
+		if not duplicates.check(fingerprint):
+			metrics.inc("duplicates_rejected")
+			return rp.Reply(rp.types.ERR_DUPLICATE)
 
 	return ch.assignMessageId(CachedMessage(user.id))
 
@@ -14,9 +14,13 @@ class SystemConfig():
 	def __init__(self):
 		self.motd = None
 		self.help = None
+		self.updateOffset = None # int, id of the last processed update
+		self.migrationVersion = None # int, cf. core.MIGRATION_VERSION
 	def defaults(self):
 		self.motd = ""
 		self.help = ""
+		self.updateOffset = 0
+		self.migrationVersion = 0
 
 USER_PROPS = (
 	"id", "username", "realname", "rank", "joined", "join_attempts", "left", "lastActive",
@@ -175,6 +179,35 @@ class Database():
 		with self.lock:
 			l = list(self.getUser(id=id) for id in self.iterateAdmins())
 		yield from l
+	# users that have a tripcode but no tripname/triphash derived from it yet
+	def iterateUsersWithoutTripname(self):
+		yield from (user for user in self.iterateUsers() if user.tripcode and not user.tripname)
+	# `rows` contains (id, tripcode, tripname, triphash), users whose tripcode
+	# changed in the meantime are left alone
+	def setTripnames(self, rows):
+		with self.lock:
+			for id, tripcode, tripname, triphash in rows:
+				with self.modifyUser(id=id) as user:
+					if user.tripcode == tripcode:
+						user.tripname = tripname
+						user.triphash = triphash
+	# `deltas` is dict(uid -> change in karma), unknown users are skipped
+	def addKarma(self, deltas):
+		with self.lock:
+			for id, n in deltas.items():
+				try:
+					with self.modifyUser(id=id) as user:
+						user.karma += n
+				except KeyError as e:
+					continue
+	# upvotes are identified by the author's id and the id of the message in
+	# their chat, `rows` contains (user_id, message_id, voter, time)
+	def addUpvotes(self, rows):
+		raise NotImplementedError()
+	def hasUpvoted(self, user_id, message_id, voter):
+		raise NotImplementedError()
+	def expireUpvotes(self, before):
+		raise NotImplementedError()
 	def modifyUser(self, **kwargs):
 		with self.lock:
 			user = self.getUser(**kwargs)
@@ -199,7 +232,7 @@ class JSONDatabase(Database):
 	def __init__(self, path):
 		super(JSONDatabase, self).__init__()
 		self.path = path
-		self.db = {"systemConfig": None, "users": []}
+		self.db = {"systemConfig": None, "users": [], "upvotes": []}
 		try:
 			self._load()
 		except FileNotFoundError as e:
@@ -211,13 +244,16 @@ class JSONDatabase(Database):
 		return
 	@staticmethod
 	def _systemConfigToDict(config):
-		return {"motd": config.motd, "help": config.help}
+		return {"motd": config.motd, "help": config.help, "updateOffset": config.updateOffset,
+			"migrationVersion": config.migrationVersion}
 	@staticmethod
 	def _systemConfigFromDict(d):
 		if d is None: return None
 		config = SystemConfig()
 		config.motd = d["motd"]
 		config.help = d["help"] if "help" in d.keys() else ""
+		config.updateOffset = d.get("updateOffset") or 0
+		config.migrationVersion = d.get("migrationVersion") or 0
 		return config
 	@staticmethod
 	def _userToDict(user):
@@ -282,6 +318,20 @@ class JSONDatabase(Database):
 		with self.lock:
 			l = list(u["id"] for u in self.db["users"])
 		yield from l
+	def addUpvotes(self, rows):
+		with self.lock:
+			upvotes = self.db.setdefault("upvotes", [])
+			for user_id, message_id, voter, t in rows:
+				upvotes.append([user_id, message_id, voter, int(t.replace(tzinfo=timezone.utc).timestamp())])
+			self._save()
+	def hasUpvoted(self, user_id, message_id, voter):
+		with self.lock:
+			return any(r[:3] == [user_id, message_id, voter] for r in self.db.get("upvotes", []))
+	def expireUpvotes(self, before):
+		before = int(before.replace(tzinfo=timezone.utc).timestamp())
+		with self.lock:
+			self.db["upvotes"] = [r for r in self.db.get("upvotes", []) if r[3] >= before]
+			self._save()
 	def getSystemConfig(self):
 		with self.lock:
 			return JSONDatabase._systemConfigFromDict(self.db["systemConfig"])
@@ -303,20 +353,23 @@ class SQLiteDatabase(Database):
 		def f():
 			with self.lock:
 				self.db.commit()
-		sched.register(f, seconds=5)
+		sched.register(f, "db_commit", seconds=5)
 	def close(self):
 		with self.lock:
 			self.db.commit()
 			self.db.close()
 	@staticmethod
 	def _systemConfigToDict(config):
-		return {"motd": config.motd, "help": config.help}
+		return {"motd": config.motd, "help": config.help, "updateOffset": config.updateOffset,
+			"migrationVersion": config.migrationVersion}
 	@staticmethod
 	def _systemConfigFromDict(d):
 		if len(d) == 0: return None
 		config = SystemConfig()
 		config.motd = d["motd"]
 		config.help = d["help"] if "help" in d.keys() else ""
+		config.updateOffset = int(d["updateOffset"]) if "updateOffset" in d.keys() else 0
+		config.migrationVersion = int(d["migrationVersion"]) if "migrationVersion" in d.keys() else 0
 		return config
 	@staticmethod
 	def _userToDict(user):
@@ -379,6 +432,15 @@ CREATE TABLE IF NOT EXISTS `users` (
 	`muzzled` TINYINT NOT NULL,
 	PRIMARY KEY (`id`)
 );
+			""".strip())
+			self.db.execute("""
+CREATE TABLE IF NOT EXISTS `upvotes` (
+	`user_id` BIGINT NOT NULL,
+	`message_id` BIGINT NOT NULL,
+	`voter` BIGINT NOT NULL,
+	`time` TIMESTAMP NOT NULL,
+	PRIMARY KEY (`user_id`, `message_id`, `voter`)
+) WITHOUT ROWID;
 			""".strip())
 			# migration
 			if not row_exists("users", "tripcode"):
@@ -501,6 +563,36 @@ CREATE TABLE IF NOT EXISTS `users` (
 			cur = self.db.execute(sql, (param, ))
 			l = list(SQLiteDatabase._userFromRow(row) for row in cur)
 		yield from l
+	def iterateUsersWithoutTripname(self):
+		sql = ("SELECT * FROM users WHERE tripcode IS NOT NULL AND tripcode != '' "
+			"AND (tripname IS NULL OR tripname = '')")
+		with self.lock:
+			cur = self.db.execute(sql)
+			l = list(SQLiteDatabase._userFromRow(row) for row in cur)
+		yield from l
+	def setTripnames(self, rows):
+		sql = "UPDATE users SET tripname = ?, triphash = ? WHERE id = ? AND tripcode = ?"
+		param = list((tripname, triphash, id, tripcode) for id, tripcode, tripname, triphash in rows)
+		with self.lock:
+			self.db.executemany(sql, param)
+	def addKarma(self, deltas):
+		sql = "UPDATE users SET karma = karma + ? WHERE id = ?"
+		param = list((n, id) for id, n in deltas.items())
+		with self.lock:
+			self.db.executemany(sql, param)
+	def addUpvotes(self, rows):
+		sql = "INSERT OR IGNORE INTO upvotes(user_id, message_id, voter, time) VALUES (?, ?, ?, ?)"
+		with self.lock:
+			self.db.executemany(sql, rows)
+	def hasUpvoted(self, user_id, message_id, voter):
+		sql = "SELECT 1 FROM upvotes WHERE user_id = ? AND message_id = ? AND voter = ?"
+		with self.lock:
+			cur = self.db.execute(sql, (user_id, message_id, voter))
+			return cur.fetchone() is not None
+	def expireUpvotes(self, before):
+		sql = "DELETE FROM upvotes WHERE time < ?"
+		with self.lock:
+			self.db.execute(sql, (before, ))
 	def getSystemConfig(self):
 		sql = "SELECT * FROM system_config"
 		with self.lock:
@@ -72,6 +72,9 @@ SPAM_LIMIT = 6
 SPAM_LIMIT_HIT = 6
 SPAM_INTERVAL_SECONDS = 5
 
+# Duplicate filter: shorter texts (e.g. "lol") are never counted as duplicates
+DUPLICATE_MIN_TEXT = 10
+
 # Spam score calculation
 SCORE_STICKER = 1.5
 SCORE_BASE_MESSAGE = 0.75
@@ -74,6 +74,7 @@ types = NumericEnum([
 	"ERR_ALREADY_UPVOTED",
 	"ERR_UPVOTE_OWN_MESSAGE",
 	"ERR_SPAMMY",
+	"ERR_DUPLICATE",
 	"ERR_SIGN_PRIVACY",
 	"ERR_SPAMMY_TRIPCODE",
 	"ERR_INVALID_TRIP_FORMAT",
@@ -90,7 +91,9 @@ types = NumericEnum([
 	"USER_INFO_MOD",
 	"USERS_INFO",
 	"USERS_INFO_EXTENDED",
+	"STATS_INFO",
 	"POLL",
+	"CLEANUP_PROGRESS",
 
 	"PROGRAM_START",
 	"PROGRAM_VERSION",
@@ -171,6 +174,7 @@ format_strs = {
 	types.ERR_ALREADY_UPVOTED: em("You have already upvoted this message."),
 	types.ERR_UPVOTE_OWN_MESSAGE: em("You can't upvote your own message."),
 	types.ERR_SPAMMY: em("Your message has not been sent. Avoid sending messages too fast, try again later."),
+	types.ERR_DUPLICATE: em("Your message has not been sent. The same content was posted too many times recently."),
 	types.ERR_SIGN_PRIVACY: em("Your account privacy settings prevent usage of the sign feature. Enable linked forwards first."),
 	types.ERR_SPAMMY_TRIPCODE: em("Your tripcode cannot be set for another {time_left} hours."),
 	types.ERR_INVALID_TRIP_FORMAT:
@@ -202,7 +206,11 @@ format_strs = {
 	types.USERS_INFO_EXTENDED:
 		"<b>{active}</b> <i>active</i>, {inactive} <i>inactive and</i> "+
 		"{blacklisted} <i>blacklisted users</i> (<i>total</i>: {total})",
+	types.STATS_INFO: lambda stats, **_:
+		"\n".join("<code>%s</code>: %s" % (escape_html(k), ("%.2f" % v) if isinstance(v, float) else v)
+			for k, v in stats.items()) or em("No statistics yet."),
 	types.POLL: "Your poll has been forwarded anonymously.",
+	types.CLEANUP_PROGRESS: em("Cleanup: {done} of {total} copies deleted."),
 
 	types.PROGRAM_START: "<b>Secret Lounge has restarted.</b>\nsecretlounge-ng v{version}",
 	types.PROGRAM_VERSION: "secretlounge-ng v{version}",
@@ -232,6 +240,7 @@ format_strs = {
 		"  /demote - demote an admin or mod to user rank\n"+
 		"  /muzzle - restricts karma and exposing (or /unmuzzle)\n" +
 		"  /reset - resets a user's karma to 0\n" +
+		"  /stats - show internal statistics\n" +
 		"\n"+
 		"<i>Or reply to a message and use</i>:\n"+
 		"  /unblacklist - show a list of users to unban (can also use /unban)",
@@ -1,17 +1,28 @@
 from datetime import datetime
 import telebot
+import requests
 from telebot import apihelper
 import logging
 import time
 import json
+import os
 import re
+import hmac
+import hashlib
+import secrets
+import inspect
+from threading import Lock, Condition, Thread
+from collections import deque
+from http.server import HTTPServer, BaseHTTPRequestHandler
 
 import traceback
 
 import src.core as core
 import src.replies as rp
 from src.database import User
-from src.util import MutablePriorityQueue
+from src.cache import CachedMessage
+from src.util import MutablePriorityQueue, KeyedWorkerPool, AIMDRate, CircuitBreaker
+from src.transport import AsyncTransport, ApiError
 from src.globals import *
 
 # Used with media_limit_period and media_enabled
@@ -28,6 +39,15 @@ HIDE_FORWARD_FROM = set([
 	"NoForwardsSourceBot", "AntiForwarded_v2_Bot", "ForwardCoverzBot",
 ])
 VENUE_PROPS = ("title", "address", "foursquare_id", "foursquare_type", "google_place_id", "google_place_type")
+DELETE_BATCH_SIZE = 100 # max. message ids per deleteMessages call
+ALLOWED_UPDATES = ["message", "edited_message", "callback_query"] # update types we have handlers for
+BLOCKED_ERRORS = ["bot was blocked by the user", "user is deactivated",
+	"PEER_ID_INVALID", "bot can't initiate conversation"] # user can't be reached anymore
+MAX_MESSAGE_LENGTH = 4096
+QUEUE_KINDS = ("relay", "system", "answer", "edit", "delete") # classes of queued items
+QUEUE_LANES = {"delete": "delete", "answer": "answer", "system": "answer",
+	"relay": "relay", "edit": "relay"} # kind -> lane it is scheduled in
+DIGEST_SEPARATOR = "\n\n———\n\n" # between the parts of a digest
 
 # Send-to types, who to reply to
 EVENT = 1
@@ -38,6 +58,13 @@ bot = None
 db = None
 ch = None
 message_queue = None
+update_workers = None
+transport = None # AsyncTransport, if enabled
+send_rate = None # AIMDRate shared by all outgoing calls
+chat_breaker = None # CircuitBreaker keyed by chat id
+digest_copies = {} # (chat id, Telegram message id) -> (Digest, msids it still shows)
+digest_lock = Lock() # protects `digest_copies`
+stopping = False # set on shutdown, no more updates are accepted
 registered_commands = {}
 
 # settings
@@ -48,11 +75,24 @@ allow_edits = None
 media_allowed = None
 media_karma = None
 karma_needed = True
+digest_backlog = None
+max_delivery_age = {} # item kind -> seconds after which it is dropped
+queue_journal = None # file pending deliveries are saved to on shutdown
+shutdown_timeout = None
 stored_key = None
 mute = False
+webhook = None # dict with url, listen, port, secret_token
+update_offset = 0 # id of the last update that was fully processed
+saved_offset = 0
+fetch_offset = 0 # id of the last update handed to the workers
+# after a week without updates Telegram continues with a random update id, an
+# update this far below `fetch_offset` means that happened (not a redelivery)
+UPDATE_ID_RESET_GAP = 100000
+pending_updates = set() # ids of updates handed to the workers but not processed yet
+update_lock = Lock() # protects the offsets and `pending_updates`
 
 def init(config, _db, _ch):
-	global bot, db, ch, message_queue, allow_documents, linked_network, tripcode_toggle, allow_edits, media_allowed, media_karma, karma_needed, VERSION, stored_key
+	global bot, db, ch, message_queue, update_workers, transport, send_rate, chat_breaker, digest_backlog, max_delivery_age, queue_journal, shutdown_timeout, allow_documents, linked_network, tripcode_toggle, allow_edits, media_allowed, media_karma, karma_needed, VERSION, stored_key, webhook, update_offset, saved_offset, fetch_offset
 	if config["bot_token"] == "":
 		logging.error("No telegram token specified.")
 		exit(1)
@@ -60,12 +100,43 @@ def init(config, _db, _ch):
 	stored_key = config["bot_token"]
 	logging.getLogger("urllib3").setLevel(logging.WARNING) # very noisy with debug otherwise
 	telebot.apihelper.READ_TIMEOUT = 20
+	api_url = config.get("bot_api_url", "https://api.telegram.org")
+	telebot.apihelper.API_URL = api_url.rstrip("/") + "/bot{0}/{1}"
 
 	bot = telebot.TeleBot(config["bot_token"], threaded=False)
+	d = config.get("send_rate") or {}
+	send_rate = AIMDRate(float(d.get("initial", 10)), float(d.get("floor", 1)), float(d.get("ceiling", 30)))
+	core.metrics.gauge("send_rate", lambda: send_rate.rate)
+	d = config.get("circuit_breaker") or {}
+	chat_breaker = CircuitBreaker(int(d.get("threshold", 5)), float(d.get("cooldown", 300)))
+	core.metrics.gauge("open_circuits", chat_breaker.openCount)
+	if config.get("async_delivery"):
+		d = config["async_delivery"]
+		if not isinstance(d, dict):
+			d = {}
+		try:
+			transport = AsyncTransport(config["bot_token"], api_url, send_rate,
+				connections=int(d.get("connections", 8)), in_flight=int(d.get("in_flight", 32)))
+		except RuntimeError as e:
+			logging.error("Can't enable async_delivery: %s", e)
+			exit(1)
+		transport.start()
 
 	db = _db # SQLiteDatabase
 	ch = _ch # Cache
-	message_queue = MutablePriorityQueue()
+	weights = {"delete": 8, "answer": 4, "relay": 1}
+	weights.update(config.get("queue_weights") or {})
+	if set(weights.keys()) != set(QUEUE_LANES.values()):
+		logging.error("'queue_weights' can only contain delete, answer and relay")
+		exit(1)
+	# relays are queued in one flow per author, so that they take turns
+	message_queue = MutablePriorityQueue(weights, flow=lambda item: item.author_id,
+		user=lambda item: item.user_id,
+		# a digest can carry several messages, deleted and expired parts are left
+		# out when it is sent (cf. send_to_single) instead
+		msid=lambda item: item.msid if item.digest is None else None,
+		author=lambda item: item.author_id if item.digest is None else None)
+	update_workers = KeyedWorkerPool(int(config.get("update_workers", 4)))
 
 	allow_contacts = config.get("allow_contacts",False)
 	allow_documents = config.get("allow_documents",False)
@@ -76,10 +147,31 @@ def init(config, _db, _ch):
 	if str(media_karma[0]) == "no":
 		karma_needed = False
 	allow_edits = config.get("allow_edits", False)
+	digest_backlog = int(config.get("digest_backlog", 0))
+	max_delivery_age = config.get("max_delivery_age") or {}
+	if not isinstance(max_delivery_age, dict) or not set(max_delivery_age.keys()) <= set(QUEUE_KINDS):
+		logging.error("'max_delivery_age' needs to map any of %s to seconds", ", ".join(QUEUE_KINDS))
+		exit(1)
+	max_delivery_age = {k: float(v) for k, v in max_delivery_age.items() if v is not None}
+	queue_journal = config.get("queue_journal", "./queue.journal")
+	shutdown_timeout = float(config.get("shutdown_timeout", 10))
 	VERSION = config.get("vanity_version", "") or VERSION
 	if linked_network is not None and not isinstance(linked_network, dict):
 		logging.error("Wrong type for 'linked_network'")
 		exit(1)
+	webhook = config.get("webhook")
+	if webhook is not None:
+		if not isinstance(webhook, dict) or not webhook.get("url"):
+			logging.error("'webhook' needs at least an 'url'")
+			exit(1)
+		webhook.setdefault("listen", "127.0.0.1")
+		webhook.setdefault("port", 8443)
+		if not webhook.get("secret_token"):
+			webhook["secret_token"] = secrets.token_urlsafe(32)
+
+	update_offset = db.getSystemConfig().updateOffset
+	saved_offset = update_offset
+	fetch_offset = update_offset
 
 	types = ["text", "location", "venue"]
 	if allow_contacts:
@@ -96,7 +188,7 @@ def init(config, _db, _ch):
 	
 	# Trimmed command list
 	cmds = [
-		"start", "stop", "users", "info", "help", "rules", "motd", "toggledebug", "togglekarma", "version", "source", "modhelp", "adminhelp", "modsay", "adminsay", "mod", "admin", "demote", "warn", "delete", "remove", "uncooldown", "whitelist", "blacklist", "unblacklist", "exposeto", "tripcode", "tripcodetoggle", "ban", "unban", "unwhitelist", "t", "tsign", "lock", "unlock", "cleanup", "muzzle", "unmuzzle", "reset", "lockdown", "mute"
+		"start", "stop", "users", "info", "help", "rules", "motd", "toggledebug", "togglekarma", "version", "source", "modhelp", "adminhelp", "modsay", "adminsay", "mod", "admin", "demote", "warn", "delete", "remove", "uncooldown", "whitelist", "blacklist", "unblacklist", "exposeto", "tripcode", "tripcodetoggle", "ban", "unban", "unwhitelist", "t", "tsign", "lock", "unlock", "cleanup", "muzzle", "unmuzzle", "reset", "lockdown", "mute", "stats"
 	]
 	for c in cmds: # maps /<c> to the function cmd_<c>
 		c = c.lower()
@@ -117,7 +209,7 @@ def init(config, _db, _ch):
 			return
 
 		if call.data.find("_cancel") >= 0:
-			core.delete_message(c_user, msid, False)
+			delete_from_chat(call.message.chat.id, msid, c_user)
 			try:
 				bot.answer_callback_query(call.id, "Cancelled", show_alert=False)
 			except Exception as e:
@@ -132,7 +224,7 @@ def init(config, _db, _ch):
 				if call.data.startswith("demote_"):
 					core.demote_user(c_user, user.id)
 				core._push_system_message(rp.Reply(rp.types.SUCCESS), who=c_user)
-				core.delete_message(c_user, msid, False)
+				delete_from_chat(call.message.chat.id, msid, c_user)
 			except KeyError as e:
 				logging.error("User not found from "+call.data[:call.data.find("_")]+" button.")
 				return #some kind of error message? no_user_found?
@@ -151,33 +243,223 @@ def set_handler(func, *args, **kwargs):
 			logging.exception("Exception raised in event handler")
 	bot.message_handler(*args, **kwargs)(wrapper)
 
+def get_update_user_id(update):
+	for ev in (update.message, update.edited_message, update.callback_query):
+		if ev is not None and ev.from_user is not None:
+			return ev.from_user.id
+	return None
+
+# hand updates received by either polling or the webhook to the workers
+# updates from the same user are processed in order, others concurrently
+def handle_updates(updates):
+	global fetch_offset
+	if stopping:
+		return # not acknowledged, so Telegram hands them out again after a restart
+	for update in updates:
+		with update_lock:
+			if update.update_id <= fetch_offset - UPDATE_ID_RESET_GAP:
+				logging.warning("Update id went back from %d to %d, resetting offset", fetch_offset, update.update_id)
+				fetch_offset = update.update_id - 1
+			if update.update_id <= fetch_offset:
+				continue # redelivery of something we already have
+			fetch_offset = update.update_id
+			pending_updates.add(update.update_id)
+		update_workers.submit(get_update_user_id(update), lambda update=update: process_update(update))
+
+def process_update(update):
+	global update_offset
+	try:
+		bot.process_new_updates([update])
+	except Exception as e:
+		# skip it, retrying would just fail again
+		logging.exception("Exception raised while processing update")
+	with update_lock:
+		pending_updates.discard(update.update_id)
+		# everything before the oldest update still being processed is done
+		if len(pending_updates) > 0:
+			update_offset = min(pending_updates) - 1
+		else:
+			update_offset = fetch_offset
+
+# persist the offset so a restart neither reprocesses nor drops updates
+def save_update_offset():
+	global saved_offset
+	offset = update_offset
+	if offset == saved_offset:
+		return
+	with db.modifySystemConfig() as config:
+		config.updateOffset = offset
+	saved_offset = offset
+
+class WebhookHandler(BaseHTTPRequestHandler):
+	def do_POST(self):
+		token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+		# headers are decoded as latin-1, compare_digest only takes ASCII strings
+		if not hmac.compare_digest(token.encode("latin-1"), webhook["secret_token"].encode("utf-8")):
+			return self.send_error(403)
+		try:
+			body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+			update = telebot.types.Update.de_json(body.decode("utf-8"))
+		except Exception as e:
+			return self.send_error(400)
+		if stopping:
+			return self.send_error(503) # Telegram retries later
+		# answer before processing, Telegram does not need to wait for us
+		self.send_response(200)
+		self.end_headers()
+		self.wfile.flush()
+		handle_updates([update])
+	def log_message(self, format, *args):
+		logging.debug("webhook: " + format, *args)
+
+def run_webhook():
+	bot.set_webhook(url=webhook["url"], secret_token=webhook["secret_token"],
+		allowed_updates=ALLOWED_UPDATES)
+	server = HTTPServer((webhook["listen"], int(webhook["port"])), WebhookHandler)
+	logging.info("Listening for webhook updates on %s:%d", webhook["listen"], int(webhook["port"]))
+	server.serve_forever()
+
 def run():
-	while True:
+	update_workers.start()
+	if webhook is not None:
+		return run_webhook()
+	try:
+		bot.remove_webhook() # getUpdates does not work while one is set
+	except Exception as e:
+		logging.warning("%s while removing webhook.", type(e).__name__)
+	# an offset confirms (and discards) all updates below it, including ones with
+	# a new random id, so it is only passed to confirm updates we received
+	seen = None # highest update id received but not confirmed yet
+	while not stopping:
 		try:
-			bot.polling(none_stop=True, long_polling_timeout=45)
+			updates = bot.get_updates(offset=None if seen is None else seen + 1,
+				allowed_updates=ALLOWED_UPDATES, timeout=20, long_polling_timeout=45)
+			handle_updates(updates)
+			# updates that were not accepted must not be confirmed
+			seen = max(u.update_id for u in updates) if len(updates) > 0 and not stopping else None
 		except Exception as e:
-			# you're not supposed to call .polling() more than once but I'm left with no choice
 			logging.warning("%s while polling Telegram, retrying.", type(e).__name__)
 			#logging.error(traceback.print_exc())
 			time.sleep(3)
 
 def register_tasks(sched):
+	sched.register(save_update_offset, "save_offset", seconds=5)
 	# cache expiration
 	def task():
 		ids = ch.expire()
 		if len(ids) == 0:
 			return
-		n = 0
-		def f(item):
-			nonlocal n
-			if item.msid in ids:
-				n += 1
-				return True
-			return False
-		message_queue.delete(f)
+		n = sum(message_queue.deleteBy("msid", msid) for msid in ids)
 		if n > 0:
 			logging.warning("Failed to deliver %d messages before they expired from cache.", n)
-	sched.register(task, hours=6) # (1/4) * cache duration
+		with digest_lock:
+			for k, (digest, msids) in list(digest_copies.items()):
+				if all(ch.getMessage(msid) is None for msid in msids):
+					del digest_copies[k]
+	sched.register(task, "cache_expiry", jitter=60, hours=6) # (1/4) * cache duration
+
+# stop accepting updates, give the queue `shutdown_timeout` seconds to drain and
+# save what is left to the journal, from where resume_queue() picks it up again
+def shutdown():
+	global stopping
+	stopping = True
+	deadline = time.monotonic() + shutdown_timeout
+	# updates being processed right now may still queue messages
+	while len(pending_updates) > 0 and time.monotonic() < deadline:
+		time.sleep(0.1)
+	while message_queue.unfinished() > 0 and time.monotonic() < deadline:
+		time.sleep(0.1)
+	if transport is not None:
+		transport.flush(max(deadline - time.monotonic(), 0))
+		transport.close()
+	write_journal(message_queue.clear())
+	save_update_offset()
+
+def write_journal(items):
+	if queue_journal is None:
+		return
+	jobs = []
+	for item in items:
+		if item.describe is not None and not item.isStale():
+			jobs.extend(item.describe())
+	if len(jobs) == 0:
+		return
+	tmp = queue_journal + ".tmp"
+	n = 0
+	with open(tmp, "w") as f:
+		for job in jobs:
+			try:
+				line = json.dumps(job)
+			except (TypeError, ValueError) as e:
+				logging.warning("Can't save queued %s job: %s", job["kind"], e)
+				continue
+			f.write(line + "\n")
+			n += 1
+	os.replace(tmp, queue_journal)
+	logging.info("Saved %d pending deliveries to %s", n, queue_journal)
+
+# queue the deliveries saved by shutdown()
+def resume_queue():
+	if queue_journal is None or not os.path.exists(queue_journal):
+		return
+	with open(queue_journal, "r") as f:
+		jobs = [json.loads(line) for line in f if line.strip() != ""]
+	msids = {} # msid before the restart -> msid now
+	def get_msid(job):
+		old = job["msid"]
+		if old is None:
+			return None
+		if old not in msids.keys():
+			msids[old] = ch.assignMessageId(CachedMessage(job["author"]))
+			if job["origin"] is not None:
+				ch.saveMapping(job["author"], msids[old], job["origin"])
+		return msids[old]
+	n = 0
+	for job in jobs:
+		try:
+			user = db.getUser(id=job["to"])
+		except KeyError as e:
+			continue
+		if job["kind"] == "delete":
+			if len(job["ids"]) == 1:
+				delete_from_chat(user.id, job["ids"][0], user)
+			else:
+				delete_many_from_chat(user.id, job["ids"], user)
+		elif user.isJoined():
+			ev = decode_event(job["event"])
+			if ev is None:
+				continue
+			force_caption = None
+			if job["caption"] is not None:
+				force_caption = FormattedMessage(*job["caption"])
+			send_to_single(ev, get_msid(job), user,
+				reply_msid=msids.get(job["reply_msid"]), force_caption=force_caption)
+		else:
+			continue
+		n += 1
+	os.remove(queue_journal)
+	logging.info("Resumed %d deliveries from %s", n, queue_journal)
+
+# JSON representation of something that send_to_single can send
+# replies are saved by type name, the numeric values change when types are added
+def encode_event(ev):
+	if isinstance(ev, rp.Reply):
+		return {"reply": [rp.types.reverse[ev.type], ev.kwargs]}
+	elif isinstance(ev, FormattedMessage):
+		return {"text": [ev.html, ev.content]}
+	return {"message": ev.json}
+
+# returns None if the event can't be sent by this version anymore
+def decode_event(d):
+	if "reply" in d.keys():
+		name, kwargs = d["reply"]
+		if name not in rp.types.keys():
+			logging.warning("Dropping saved reply of unknown type %s", name)
+			return None
+		return rp.Reply(rp.types[name], **kwargs)
+	elif "text" in d.keys():
+		return FormattedMessage(*d["text"])
+	return telebot.types.Message.de_json(d["message"])
 
 def start_edit_listener():
 	@bot.edited_message_handler(func=lambda msg: True)
@@ -189,35 +471,41 @@ def start_edit_listener():
 		if not allow_edits:
 			return core._push_system_message(rp.Reply(rp.types.ERR_NO_EDITING),who=c_user)
 
-		if ev.content_type=="text":
-			#Just need to use the right user_id, I think, and it'll come out with the correct message id.
-			cache_msid = ch.lookupMapping(ev.from_user.id, data=ev.message_id)
-			if cache_msid is None:
-				# FIX: messages should be more like the rest, with ev
-				core._push_system_message(rp.Reply(rp.types.ERR_NOT_IN_CACHE),who=c_user)
-				return
+		if ev.content_type != "text" and ev.content_type not in CAPTIONABLE_TYPES:
+			return
 
-			fmt = FormattedMessageBuilder(None, ev.caption, ev.text)
-			formatter_replace_links(ev, fmt)
-			formatter_network_links(fmt)
-			# FIX: can store whether a tripcode was used
-			# if tripcode or c_user.tripcodeToggle:
-			if not tripcode_toggle or c_user.tripcodeToggle:
-				if c_user.tripcode is None:
-					core._push_system_message(rp.Reply(rp.types.ERR_NEED_TRIPCODE), who=c_user)
-
-				formatter_tripcoded_message(c_user, fmt)
-			formatter_edited_message(fmt)
-			fmt = fmt.build()
-
-			for user in db.iterateUsers():
-				if user.id == ev.chat.id:
-					continue
-				chat_msid = ch.lookupMapping(user.id, msid=cache_msid)
-				try:
-					bot.edit_message_text(fmt.content, user.id, chat_msid, parse_mode="HTML")
-				except Exception as e:
-					logging.error("Error editing message. "+str(e))
+		#Just need to use the right user_id, I think, and it'll come out with the correct message id.
+		cache_msid = ch.lookupMapping(ev.from_user.id, data=ev.message_id)
+		if cache_msid is None:
+			# FIX: messages should be more like the rest, with ev
+			core._push_system_message(rp.Reply(rp.types.ERR_NOT_IN_CACHE),who=c_user)
+			return
+
+		fmt = FormattedMessageBuilder(None, ev.caption, ev.text, "")
+		formatter_replace_links(ev, fmt)
+		formatter_network_links(fmt)
+		# FIX: can store whether a tripcode was used
+		# if tripcode or c_user.tripcodeToggle:
+		if not tripcode_toggle or c_user.tripcodeToggle:
+			if c_user.tripcode is None:
+				return core._push_system_message(rp.Reply(rp.types.ERR_NEED_TRIPCODE), who=c_user)
+
+			formatter_tripcoded_message(c_user, fmt)
+		formatter_edited_message(fmt)
+		fmt = fmt.build()
+
+		# only users that actually received the message get an edit
+		for user_id, chat_msid in ch.getRecipients(cache_msid).items():
+			if user_id == ev.chat.id or chat_msid in (None, -1):
+				continue
+			# editing a digest would replace the other messages in it
+			if (user_id, chat_msid) in digest_copies:
+				continue
+			try:
+				user = db.getUser(id=user_id)
+			except KeyError as e:
+				continue
+			edit_to_single(fmt, cache_msid, user, chat_msid, caption=ev.content_type != "text")
 
 
 # Wraps a telegram user in a consistent class (used by core.py)
@@ -253,7 +541,7 @@ def removeSensitiveInfo(ev, arg):
 	# is username and not tripcode, or is ID, delete
 	args = arg.split(" ")
 	if (args[0].startswith("@") and args[0].find("!") < 0 or re.search("^[0-9+]{5,}$",args[0]) is not None):
-		core.delete_message(c_user, ev.message_id, False)
+		delete_from_chat(ev.chat.id, ev.message_id)
 		send_answer(ev, rp.Reply(rp.types.SENSITIVE))
 		return "##"+arg
 	return arg
@@ -285,8 +573,10 @@ def send_answer(ev, m, reply_to=None):
 		reply_to = ev.reply_to_message.message_id
 	def f(ev=ev, m=m):
 		while True:
+			send_rate.wait()
 			try:
 				send_to_single_inner(ev.chat.id, m, reply_to=reply_to)
+				send_rate.success()
 			except telebot.apihelper.ApiException as e:
 				logging.info("Send failed. ID: %d",ev.chat.id)
 				retry = check_telegram_exc(e, None)
@@ -299,7 +589,7 @@ def send_answer(ev, m, reply_to=None):
 		user = db.getUser(id=ev.from_user.id)
 	except KeyError as e:
 		user = None # happens on e.g. /start
-	put_into_queue(user, None, f)
+	put_into_queue(user, None, f, "answer")
 
 # TODO: find a better place for this
 def allow_message_text(text):
@@ -329,6 +619,22 @@ def calc_spam_score(ev):
 	s += len(ev.text) * SCORE_TEXT_CHARACTER + ev.text.count("\n") * SCORE_TEXT_LINEBREAK
 	return s
 
+# identifies the content of a message for core's duplicate filter, so that
+# copies match regardless of case, whitespace or sender (None: not checked)
+def calc_fingerprint(ev):
+	if ev.content_type == "text":
+		text = " ".join(ev.text.casefold().split())
+		if len(text) < DUPLICATE_MIN_TEXT:
+			return None
+		return "text:" + hashlib.blake2b(text.encode("utf-8"), digest_size=12).hexdigest()
+	media = getattr(ev, ev.content_type, None)
+	if isinstance(media, list): # photo sizes
+		media = media[-1] if len(media) > 0 else None
+	file_id = getattr(media, "file_unique_id", None)
+	if file_id is None:
+		return None
+	return "file:" + file_id
+
 ###
 
 # Formatting for user messages, which are largely passed through as-is
@@ -436,13 +742,30 @@ def formatter_edited_message(fmt: FormattedMessageBuilder):
 # Message sending (queue-related)
 
 class QueueItem():
-	__slots__ = ("user_id", "msid", "func")
-	def __init__(self, user, msid, func):
+	__slots__ = ("user_id", "msid", "author_id", "func", "kind", "queued", "digest", "describe")
+	def __init__(self, user, msid, func, kind, digest=None, describe=None):
 		self.user_id = None # who this item is being delivered to
 		if user is not None:
 			self.user_id = user.id
 		self.msid = msid # message id connected to this item
+		self.author_id = None # who wrote that message
+		cm = ch.getMessage(msid) if msid is not None else None
+		if cm is not None:
+			self.author_id = cm.user_id
 		self.func = func
+		self.kind = kind # one of QUEUE_KINDS
+		self.queued = time.monotonic() # for a digest: when its oldest part was queued
+		self.digest = digest # Digest that later items can be merged into
+		# func that returns the jobs to journal for this item (cf. resume_queue)
+		self.describe = describe
+	# was this item queued for longer than its kind may be?
+	def isStale(self):
+		age = max_delivery_age.get(self.kind)
+		if age is None:
+			return False
+		# older parts of a digest are dropped when it is sent (cf. send_to_single)
+		queued = self.queued if self.digest is None else self.digest.newest
+		return time.monotonic() - queued > age
 	def call(self):
 		try:
 			self.func()
@@ -460,13 +783,95 @@ def get_priority_for(user):
 		return max(RANKS.values()) << 16
 	return user.getMessagePriority()
 
-def put_into_queue(user, msid, f):
-	message_queue.put(get_priority_for(user), QueueItem(user, msid, f))
+# plain-text relays to a single recipient, sent together as one message
+# if the recipient has a backlog when they are queued
+class Digest():
+	def __init__(self, msid, ev, reply_msid):
+		if isinstance(ev, FormattedMessage):
+			content = ev.content if ev.html else escape_html(ev.content)
+		else:
+			content = escape_html(ev.text)
+		self.parts = [(msid, content)]
+		self.reply_msid = reply_msid
+		self.length = len(content)
+		self.queued = {msid: time.monotonic()} # msid -> when that part was queued
+		self.newest = self.queued[msid]
+	@staticmethod
+	def can_contain(ev):
+		if isinstance(ev, FormattedMessage):
+			return True
+		return (isinstance(ev, telebot.types.Message) and ev.content_type == "text"
+			and not is_forward(ev))
+	# append the single part of `other`, returns whether that was possible
+	def merge(self, other):
+		(msid, content), = other.parts
+		if other.reply_msid is not None and self.reply_msid not in (None, other.reply_msid):
+			return False
+		length = self.length + len(DIGEST_SEPARATOR) + len(content)
+		if length > MAX_MESSAGE_LENGTH:
+			return False
+		self.queued[msid] = other.queued[msid]
+		self.parts.append((msid, content))
+		self.length = length
+		self.newest = other.newest
+		if other.reply_msid is not None:
+			self.reply_msid = other.reply_msid
+		return True
+	# was part `msid` queued for longer than `age` seconds (None: no limit)?
+	def isStale(self, msid, age):
+		return age is not None and time.monotonic() - self.queued[msid] > age
+	def build(self, msids):
+		return FormattedMessage(True, DIGEST_SEPARATOR.join(c for msid, c in self.parts if msid in msids))
+
+# the messages `msids` shown by `chat_msid` in chat `user_id` were deleted: a
+# digest is edited to leave them out, returns True if the whole chat message
+# has to be deleted instead
+def remove_from_digest(user_id, chat_msid, msids, user):
+	k = (user_id, chat_msid)
+	with digest_lock:
+		if k not in digest_copies.keys():
+			return True
+		digest, left = digest_copies[k]
+		left = [m for m in left if m not in msids]
+		if len(left) == 0 or user is None:
+			del digest_copies[k]
+			return True
+		digest_copies[k] = (digest, left)
+		# queued while holding the lock, so that edits are sent in order
+		edit_to_single(digest.build(left), left[0], user, chat_msid)
+	return False
+
+def put_into_queue(user, msid, f, kind, digest=None, describe=None):
+	item = QueueItem(user, msid, f, kind, digest, describe)
+	merge = None
+	if digest is not None and digest_backlog > 0:
+		# only into the recipient's last pending item, anything queued after
+		# the digest (media, system messages) must stay behind the merged text
+		def merge_digest(last, n):
+			if n < digest_backlog or last.digest is None or not last.digest.merge(digest):
+				return False
+			core.metrics.inc("digest_merged")
+			return True
+		merge = merge_digest
+	message_queue.put(get_priority_for(user), item, merge, "user", QUEUE_LANES[kind])
 
 def send_thread():
 	while True:
 		item = message_queue.get()
-		item.call()
+		if item.isStale():
+			core.metrics.inc("dropped_stale_" + item.kind)
+			message_queue.task_done()
+			continue
+		start = time.monotonic()
+		try:
+			if inspect.iscoroutinefunction(item.func):
+				transport.submit(item.func, item.user_id) # returns once the call is in flight
+			else:
+				item.call()
+		finally:
+			message_queue.task_done()
+		logging.debug("sent", extra={"kind": item.kind, "msid": item.msid, "uid": item.user_id,
+			"wait": start - item.queued, "latency": time.monotonic() - item.queued})
 
 ###
 
@@ -585,6 +990,39 @@ def send_to_single_inner(chat_id, ev, reply_to=None, force_caption=None):
 
 	return resend_message(chat_id, ev, reply_to=reply_to, force_caption=force_caption)
 
+# same as send_to_single_inner, but through `transport`
+# returns the id of the sent Telegram message
+async def send_to_single_async(chat_id, ev, reply_to=None, force_caption=None):
+	kwargs = {"chat_id": chat_id}
+	if reply_to is not None:
+		kwargs["reply_to_message_id"] = reply_to
+		kwargs["allow_sending_without_reply"] = True
+
+	if isinstance(ev, rp.Reply): # System message?
+		if ev.type == rp.types.CUSTOM:
+			kwargs["disable_web_page_preview"] = True
+		if not ev.buttons == [[]]:
+			kwargs["reply_markup"] = {"inline_keyboard": ev.buttons}
+		ret = await transport.call("sendMessage", text=rp.formatForTelegram(ev), parse_mode="HTML", **kwargs)
+	elif isinstance(ev, FormattedMessage): # Tripcode
+		if ev.html:
+			kwargs["parse_mode"] = "HTML"
+		ret = await transport.call("sendMessage", text=ev.content, **kwargs)
+	elif ev.content_type == "poll" or (is_forward(ev) and not should_hide_forward(ev)
+		and get_forwardid(ev) != ev.from_user.id):
+		# cf. resend_message
+		ret = await transport.call("forwardMessage", chat_id=chat_id,
+			from_chat_id=ev.chat.id, message_id=ev.message_id)
+	else:
+		# copyMessage re-sends any content type without the forward header
+		if ev.content_type in CAPTIONABLE_TYPES and force_caption is not None:
+			kwargs["caption"] = force_caption.content
+			if force_caption.html:
+				kwargs["parse_mode"] = "HTML"
+		ret = await transport.call("copyMessage", from_chat_id=ev.chat.id,
+			message_id=ev.message_id, **kwargs)
+	return ret["message_id"]
+
 # queue sending of a single message `ev` (multiple types possible) to User `user`
 # this includes saving of the sent message id to the cache mapping.
 # `reply_msid` can be a msid of the message that will be replied to
@@ -596,51 +1034,295 @@ def send_to_single(ev, msid, user, *, reply_msid=None, force_caption=None):
 		if reply_to is None:
 			core._push_system_message(rp.Reply(rp.types.CUSTOM,text="<i>This message was sent before you\narrived, or no longer exists.</i>"), who=user, msid=reply_msid)
 			logging.info(f"reply associated with {reply_msid}")
+	if msid is not None:
+		# Stub mapping so that instant sends can be told that there is an EXPECTED msid involved, even if there's none now.
+		# Fix: some places should probably check if msid is -1 and throw a "not found" anyway.
+		ch.saveMapping(user_id, msid, -1)
+	# the stub is dropped together with all other mappings when the message
+	# is deleted (or expires), so there is nothing left to send
+	def is_deleted(msid):
+		return msid is not None and ch.lookupMapping(user_id, msid=msid) is None
+	def get_reply_to(reply_msid):
+		# set reply_to_message_id if applicable
+		reply_to = None
+		if reply_msid is not None:
+			reply_to = ch.lookupMapping(user.id, msid=reply_msid)
+			if reply_to is None:
+				logging.info("Likely replying to a deleted message.")
+			elif reply_to == -1:
+				logging.info(f"User {user.id} still had {msid} as -1 at ToF.")
+		return reply_to
+	digest = None
+	if msid is not None and force_caption is None and Digest.can_contain(ev):
+		digest = Digest(msid, ev, reply_msid)
+	# returns what to send, its reply target and the msids it covers,
+	# the latter is empty if everything was deleted in the meantime
+	def prepare():
+		if digest is None or len(digest.parts) == 1:
+			return ev, reply_msid, [] if is_deleted(msid) else [msid]
+		age = max_delivery_age.get(kind)
+		msids = [m for m, _ in digest.parts if not is_deleted(m) and not digest.isStale(m, age)]
+		if msids == [msid]:
+			return ev, reply_msid, msids
+		return digest.build(msids), digest.reply_msid, msids
+	# messages deleted while this was being sent are removed from the chat again
+	def save(msids, chat_msid):
+		if len(msids) > 1:
+			# registered first, so that deletions from now on only remove their part
+			with digest_lock:
+				digest_copies[(user_id, chat_msid)] = (digest, list(msids))
+		deleted = [m for m in msids if not ch.saveMapping(user_id, m, chat_msid)]
+		if len(deleted) > 0 and remove_from_digest(user_id, chat_msid, deleted, user):
+			delete_from_chat(user_id, chat_msid, user)
+	# deliveries to chats that keep failing are skipped until their circuit closes
+	def is_skipped():
+		if chat_breaker.allow(user_id):
+			return False
+		core.metrics.inc("circuit_skipped")
+		return True
 	def f():
-		while True:
+		ev_, reply_msid_, msids = prepare()
+		if len(msids) == 0 or is_skipped():
+			return
+		try:
 			count = 1
+			while True:
+				send_rate.wait()
+				try:
+					ev2 = send_to_single_inner(user_id, ev_, get_reply_to(reply_msid_), force_caption)
+				#FIX: This is because of my deletion code
+				except telebot.apihelper.ApiTelegramException as e:
+					if e.error_code == 429:
+						check_telegram_exc(e, user_id) # lowers send_rate
+						if count < 5:
+							count += 1
+							continue
+						return
+					logging.info(f"Error sending single: {e}")
+					if str(e).find("user is deactivated") >= 0:
+						core.force_user_leave(user.id)
+					elif str(e).find("bot was blocked") >= 0:
+						core.force_user_leave(user.id)
+					elif is_chat_failure(e.error_code, e.description):
+						chat_breaker.failure(user_id)
+					return
+				except telebot.apihelper.ApiException as e:
+					retry = check_telegram_exc(e, user_id)
+					if retry and count < 5:
+						count += 1
+						logging.info(f"Bad thing, retrying... {e}")
+						continue
+					if not retry and is_chat_failure(e.result.status_code, e.result.text):
+						chat_breaker.failure(user_id)
+					return
+				except requests.exceptions.RequestException as e:
+					logging.info("%s while sending to %d", type(e).__name__, user_id)
+					if chat_breaker.failure(user_id) or count >= 5:
+						return
+					count += 1
+					time.sleep(1)
+					continue
+				break
+			send_rate.success()
+			chat_breaker.success(user_id)
+		finally:
+			chat_breaker.release(user_id)
+		save(msids, ev2.message_id)
+
+	async def af():
+		ev_, reply_msid_, msids = prepare()
+		if len(msids) == 0 or is_skipped():
+			return
+		try:
+			count = 1
+			while True:
+				try:
+					chat_msid = await send_to_single_async(user_id, ev_, get_reply_to(reply_msid_), force_caption)
+				except ApiError as e:
+					wait = check_api_error(e, user_id)
+					if is_chat_failure(e.error_code, e.description) and chat_breaker.failure(user_id):
+						return
+					if wait is not None and count < 5:
+						count += 1
+						await transport.backoff(wait)
+						continue
+					return
+				break
+			chat_breaker.success(user_id)
+		finally:
+			chat_breaker.release(user_id)
+		save(msids, chat_msid)
+
+	def describe():
+		if digest is None or len(digest.parts) == 1:
+			parts = [(msid, ev, reply_msid)]
+		else:
+			parts = [(m, FormattedMessage(True, c), None) for m, c in digest.parts]
+			parts[0] = parts[0][:2] + (digest.reply_msid, )
+		jobs = []
+		for m, ev_, reply_msid_ in parts:
+			if is_deleted(m):
+				continue
+			cm = ch.getMessage(m) if m is not None else None
+			author = cm.user_id if cm is not None else None
+			origin = ch.lookupMapping(author, msid=m) if author is not None else None
+			jobs.append({"kind": "send", "to": user_id, "msid": m, "author": author,
+				"origin": origin if origin != -1 else None, "reply_msid": reply_msid_,
+				"event": encode_event(ev_), "caption": None if force_caption is None
+				else [force_caption.html, force_caption.content]})
+		return jobs
+
+	kind = "system" if isinstance(ev, rp.Reply) else "relay"
+	put_into_queue(user, msid, af if transport is not None else f, kind, digest, describe)
+
+
+# queue deletion of the Telegram message `chat_msid` in chat `chat_id`
+# `user` (if known) is only used to prioritize the deletion
+def delete_from_chat(chat_id, chat_msid, user=None):
+	def f():
+		count = 0
+		while True:
+			count += 1
+			send_rate.wait()
 			try:
-				# set reply_to_message_id if applicable
-				reply_to = None
-				if reply_msid is not None:
-					reply_to = ch.lookupMapping(user.id, msid=reply_msid)
-					if reply_to is None:
-						logging.info("Likely replying to a deleted message.")
-					elif reply_to == -1:
-						logging.info(f"User {user.id} still had {msid} as -1 at ToF.")
-				ev2 = send_to_single_inner(user_id, ev, reply_to, force_caption)
-			#FIX: This is because of my deletion code
+				bot.delete_message(chat_id, chat_msid)
 			except telebot.apihelper.ApiTelegramException as e:
-				logging.info(f"Error sending single: {e}")
-				if str(e).find("user is deactivated") >= 0:
-					core.force_user_leave(user.id)
-				if str(e).find("bot was blocked") >= 0:
-					core.force_user_leave(user.id)
+				if e.error_code == 429:
+					check_telegram_exc(e, None) # lowers send_rate
+					if count < 10:
+						continue
+					logging.info(f"Delete failed because of long wait. {chat_id}:{chat_msid}")
+					return
+				logging.info("API Error. Already deleted.")
 				return
 			except telebot.apihelper.ApiException as e:
-				retry = check_telegram_exc(e, user_id)
-				if retry and count < 5:
-					count += 1
-					logging.info(f"Bad thing, retrying... {e}")
-					time.sleep(1)
+				logging.info("Delete failed. ID: %d", chat_id)
+				retry = check_telegram_exc(e, None)
+				if retry and count < 10:
 					continue
+				if count >= 10:
+					logging.info(f"Delete failed because of long wait. {chat_id}:{chat_msid}")
 				return
 			break
-		ch.saveMapping(user_id, msid, ev2.message_id)
-
-		time.sleep(0.1)
-		# pauses after sending, might help with rate limits.
-
+	async def af():
+		count = 0
+		while True:
+			count += 1
+			try:
+				await transport.call("deleteMessage", chat_id=chat_id, message_id=chat_msid)
+			except ApiError as e:
+				wait = check_api_error(e, None, quiet=True)
+				if wait is not None and count < 10:
+					await transport.backoff(wait)
+					continue
+				return
+			break
+	describe = lambda: [{"kind": "delete", "to": chat_id, "ids": [chat_msid]}]
+	# queued message has msid=None here since this is a deletion, not a message being sent
+	put_into_queue(user, None, af if transport is not None else f, "delete", describe=describe)
 
-	put_into_queue(user, msid, f)
+# queue deletion of the Telegram messages `chat_msids` (at most DELETE_BATCH_SIZE)
+# in chat `chat_id` with a single call, `progress` is a BulkProgress or None
+def delete_many_from_chat(chat_id, chat_msids, user=None, progress=None):
+	def f():
+		count = 0
+		while True:
+			count += 1
+			send_rate.wait()
+			try:
+				bot.delete_messages(chat_id, chat_msids)
+			except telebot.apihelper.ApiException as e:
+				logging.info("Bulk delete failed. ID: %d", chat_id)
+				retry = check_telegram_exc(e, None)
+				if retry and count < 10:
+					continue
+			break
+		if progress is not None:
+			progress.advance(len(chat_msids))
+	async def af():
+		count = 0
+		while True:
+			count += 1
+			try:
+				await transport.call("deleteMessages", chat_id=chat_id, message_ids=chat_msids)
+			except ApiError as e:
+				wait = check_api_error(e, None)
+				if wait is not None and count < 10:
+					await transport.backoff(wait)
+					continue
+			break
+		if progress is not None:
+			progress.advance(len(chat_msids))
+	describe = lambda: [{"kind": "delete", "to": chat_id, "ids": list(chat_msids)}]
+	put_into_queue(user, None, af if transport is not None else f, "delete", describe=describe)
+
+# Reports the progress of a bulk deletion to User `who` in quarter steps
+class BulkProgress():
+	def __init__(self, who, total):
+		self.lock = Lock()
+		self.who = who
+		self.total = total
+		self.done = 0
+		self.reported = 0
+	def advance(self, n):
+		with self.lock:
+			self.done += n
+			step = self.done * 4 // max(self.total, 1)
+			if step <= self.reported:
+				return
+			self.reported = step
+			done = self.done
+		self.report(done)
+	def report(self, done):
+		m = rp.Reply(rp.types.CLEANUP_PROGRESS, done=done, total=self.total)
+		core._push_system_message(m, who=self.who)
+
+# queue editing of the copy `chat_msid` of message `msid` that User `user` received
+# `fmt` is the new FormattedMessage, `caption` edits the caption of media instead of the text
+def edit_to_single(fmt, msid, user, chat_msid, *, caption=False):
+	kwargs = {}
+	if fmt.html:
+		kwargs["parse_mode"] = "HTML"
+	def f():
+		if not chat_breaker.allow(user.id):
+			core.metrics.inc("circuit_skipped")
+			return
+		try:
+			count = 0
+			while True:
+				count += 1
+				send_rate.wait()
+				try:
+					if caption:
+						bot.edit_message_caption(fmt.content, user.id, chat_msid, **kwargs)
+					else:
+						bot.edit_message_text(fmt.content, user.id, chat_msid, **kwargs)
+				except telebot.apihelper.ApiException as e:
+					logging.info("Edit failed. ID: %d", user.id)
+					retry = check_telegram_exc(e, user.id)
+					if retry and count < 5:
+						continue
+					if not retry and is_chat_failure(e.result.status_code, e.result.text):
+						chat_breaker.failure(user.id)
+					return
+				except requests.exceptions.RequestException as e:
+					logging.info("%s while editing for %d", type(e).__name__, user.id)
+					if chat_breaker.failure(user.id) or count >= 5:
+						return
+					time.sleep(1)
+					continue
+				break
+			send_rate.success()
+			chat_breaker.success(user.id)
+		finally:
+			chat_breaker.release(user.id)
 
+	put_into_queue(user, msid, f, "edit")
 
 # look at given Exception `e`, force-leave user if bot was blocked
 # returns True if message sending should be retried
 def check_telegram_exc(e, user_id):
-	errmsgs = ["bot was blocked by the user", "user is deactivated",
-		"PEER_ID_INVALID", "bot can't initiate conversation"]
-	if any(msg in e.result.text for msg in errmsgs):
+	if any(msg in e.result.text for msg in BLOCKED_ERRORS):
 		if user_id is not None:
 			core.force_user_leave(user_id)
 		return False
@@ -649,12 +1331,41 @@ def check_telegram_exc(e, user_id):
 		d = json.loads(e.result.text)["parameters"]["retry_after"]
 		d = min(d, 30) # supposedly this is in seconds, but you sometimes get 100 or even 2000
 		logging.warning("API rate limit hit, waiting for %ds", d)
-		time.sleep(d)
+		send_rate.throttled(d) # the next send_rate.wait() sits out the pause
 		return True # retry
 
 	logging.exception("API exception")
 	return False
 
+# same as check_telegram_exc, but for an ApiError from `transport`
+# returns the seconds to wait before retrying or None if it shouldn't be retried
+def check_api_error(e, user_id, quiet=False):
+	if any(msg in e.description for msg in BLOCKED_ERRORS):
+		if user_id is not None:
+			core.force_user_leave(user_id)
+		return None
+
+	if e.retry_after is not None:
+		# the transport already lowered send_rate
+		d = min(e.retry_after, 30) # cf. check_telegram_exc
+		logging.warning("API rate limit hit, waiting for %ds", d)
+		return d
+	if e.error_code is None: # network trouble
+		logging.info("Retrying %s", e)
+		return 1
+
+	if not quiet:
+		logging.warning("API error: %s", e)
+	return None
+
+# whether a failed call shows that the chat itself is in trouble, so that it
+# counts against the chat's circuit, as opposed to a bad message (400), the
+# rate limit or a user that is gone (`error_code` is None if nothing answered)
+def is_chat_failure(error_code, description):
+	if error_code == 429 or any(msg in description for msg in BLOCKED_ERRORS):
+		return False
+	return error_code is None or error_code == 403 or error_code >= 500
+
 ####
 
 # Event receiver: handles all things the core decides to do "on its own":
@@ -673,79 +1384,60 @@ class MyReceiver(core.Receiver):
 				continue
 			if user == except_who and not user.debugEnabled:
 				continue
-			# Stub mapping so that instant sends can be told that there is an EXPECTED msid involved, even if there's none now.
-			# Fix: some places should probably check if msid is -1 and throw a "not found" anyway.
-			ch.saveMapping(user.id, msid, -1)
 			send_to_single(m, msid, user, reply_msid=reply_msid)
 
 	@staticmethod
-	def delete(msid, user_id=None):
-		tmp = ch.getMessage(msid)
-		# The following stops it from being deleted on the original user's end.
-		#except_id = None if tmp is None else tmp.user_id 
-
-		#FIX: If it's something like modsay, delete. If user message, don't.
-		message_queue.delete(lambda item, msid=msid: item.msid == msid)
-		# FIXME: there's a hard to avoid race condition here:
-		# if a message is currently being sent, but finishes after we grab the
-		# message ids it will never be deleted
-
-		# When the system deletes the user's message without their input
-		# (Just used for sensitive data right now, maybe polls)
-		# FIX: This is different from stock SecretLounge, and doesn't work unless the user ID is passed in, even though it's not needed. Uh, just don't require it? Or pull it from the msid?
-		try:
-			id = ch.lookupMapping(user_id, msid=msid)
-			bot.delete_message(user_id, msid)
-		except telebot.apihelper.ApiException as e:
-			logging.info("Stock Delete failed. ID: %d",user_id)
-
-		for user in db.iterateUsers():
-			# if not user.isJoined():
-			# 	continue
-			# if user.id == except_id:
-			# 	continue
-
-			id = ch.lookupMapping(user.id, msid=msid)
-			if id is None:
+	def delete(msid):
+		# the message is marked as deleted, so sends that are still in progress
+		# delete their copy once they finish (cf. send_to_single)
+		# This includes the original user's own copy (e.g. polls) if it is mapped.
+		for user_id, id in ch.markDeleted(msid).items():
+			# still queued: dropping the mapping makes the send a no-op
+			if id is None or id == -1:
 				continue
-			user_id = user.id
-			def f(user_id=user_id, id=id):
-				count = 0
-				while True:
-					count += 1
-					try:
-						bot.delete_message(user_id, id)
-					except telebot.apihelper.ApiTelegramException as e:
-						logging.info("API Error. Already deleted.")
-						return
-					except telebot.apihelper.ApiException as e:
-						logging.info("Delete failed 2. ID: %d",user_id)
-						retry = check_telegram_exc(e, None)
-						if count >= 10:
-							logging.info(f"Delete failed because of long wait. {user_id}:{id}")
-							return
-						if retry and count < 10:
-							continue
-						return
-					break
-			# queued message has msid=None here since this is a deletion, not a message being sent
-			put_into_queue(user, None, f)
-		# drop the mappings for this message so the id doesn't end up used e.g. for replies
-		ch.deleteMappings(msid)
+			try:
+				user = db.getUser(id=user_id)
+			except KeyError as e:
+				user = None
+			# other users' messages in the same digest stay
+			if remove_from_digest(user_id, id, [msid], user):
+				delete_from_chat(user_id, id, user)
+	@staticmethod
+	def delete_bulk(msids, who):
+		parts = {} # (user_id, Telegram message id) -> deleted msids it shows
+		for msid in msids:
+			for user_id, id in ch.markDeleted(msid).items():
+				if id is None or id == -1:
+					continue
+				parts.setdefault((user_id, id), []).append(msid)
+		users = {} # user_id -> User or None
+		chats = {} # user_id -> list of Telegram message ids
+		for (user_id, id), deleted in parts.items():
+			if user_id not in users.keys():
+				try:
+					users[user_id] = db.getUser(id=user_id)
+				except KeyError as e:
+					users[user_id] = None
+			if remove_from_digest(user_id, id, deleted, users[user_id]):
+				chats.setdefault(user_id, []).append(id)
+
+		progress = None
+		if who is not None:
+			progress = BulkProgress(who, sum(len(ids) for ids in chats.values()))
+			if len(chats) == 0:
+				progress.report(0)
+		for user_id, ids in chats.items():
+			for i in range(0, len(ids), DELETE_BATCH_SIZE):
+				delete_many_from_chat(user_id, ids[i:i+DELETE_BATCH_SIZE], users[user_id], progress)
 	@staticmethod
 	def stop_invoked(user, delete_out):
-		message_queue.delete(lambda item, user_id=user.id: item.user_id == user_id)
+		message_queue.deleteBy("user", user.id)
 		if not delete_out:
 			return
-		# delete all (pending) outgoing messages written by the user
-		def f(item):
-			if item.msid is None:
-				return False
-			cm = ch.getMessage(item.msid)
-			if cm is None:
-				return False
-			return cm.user_id == user.id
-		message_queue.delete(f)
+		# delete all (pending) outgoing messages written by the user, including
+		# the ones merged into digests (which send_to_single leaves out then)
+		message_queue.deleteBy("author", user.id)
+		ch.dropUndelivered(user.id)
 
 
 #dict list parse except
@@ -760,9 +1452,59 @@ def log_into_channel(msg, html=False):
 	except:
 		pass
 
+# Records are shipped to the channel by a background thread, batched into as
+# few messages as possible and at most one message every `interval` seconds.
+# If they come in faster than that, the oldest ones are dropped.
 class ChannelHandler(logging.StreamHandler):
+	def __init__(self, capacity=1000, interval=3):
+		super(ChannelHandler, self).__init__()
+		self.lines = deque(maxlen=capacity)
+		self.dropped = 0
+		self.interval = interval
+		self.cond = Condition()
+		t = Thread(target=self._ship)
+		t.daemon = True
+		t.start()
 	def emit(self, record):
-		log_into_channel(self.format(record))
+		if bot is None or not core.log_channel:
+			return
+		try:
+			line = self.format(record)
+		except Exception as e:
+			return self.handleError(record)
+		with self.cond:
+			if len(self.lines) == self.lines.maxlen:
+				self.dropped += 1
+			self.lines.append(line[:MAX_MESSAGE_LENGTH])
+			self.cond.notify()
+	def _take(self):
+		with self.cond:
+			while len(self.lines) == 0:
+				self.cond.wait()
+			batch = []
+			if self.dropped > 0:
+				batch.append("(%d older log messages dropped)" % self.dropped)
+				self.dropped = 0
+			length = sum(len(s) + 1 for s in batch)
+			while len(self.lines) > 0 and length + len(self.lines[0]) <= MAX_MESSAGE_LENGTH:
+				length += len(self.lines[0]) + 1
+				batch.append(self.lines.popleft())
+			return "\n".join(batch)
+	# logging from here would feed back into this handler, so errors are ignored
+	def _ship(self):
+		while True:
+			msg = self._take()
+			for i in range(3):
+				try:
+					bot.send_message(core.log_channel, msg)
+				except telebot.apihelper.ApiTelegramException as e:
+					if e.error_code == 429:
+						time.sleep(e.result_json.get("parameters", {}).get("retry_after", self.interval))
+						continue
+				except Exception as e:
+					pass
+				break
+			time.sleep(self.interval)
 
 ####
 
@@ -835,6 +1577,7 @@ def cmd_tripcode(ev, arg):
 
 
 cmd_modhelp = wrap_core(core.modhelp, reply_to=EVENT)
+cmd_stats = wrap_core(core.get_stats, reply_to=EVENT)
 cmd_adminhelp = wrap_core(core.adminhelp, reply_to=EVENT)
 
 def cmd_version(ev):
@@ -1068,7 +1811,7 @@ def relay(ev):
 # returns void
 def relay_inner(ev, *, caption_text=None, expose=False, signed=False, tripcode=False):
 	is_media = is_forward(ev) or ev.content_type in MEDIA_FILTER_TYPES
-	msid = core.prepare_user_message(UserContainer(ev.from_user), calc_spam_score(ev), is_media=is_media, expose=expose, tripcode=tripcode)
+	msid = core.prepare_user_message(UserContainer(ev.from_user), calc_spam_score(ev), is_media=is_media, expose=expose, tripcode=tripcode, fingerprint=calc_fingerprint(ev))
 	if msid is None or isinstance(msid, rp.Reply):
 		return send_answer(ev, msid) # don't relay message, instead reply
 
@@ -1174,7 +1917,7 @@ def relay_inner(ev, *, caption_text=None, expose=False, signed=False, tripcode=F
 
 
 	# relay message to all other users
-	logging.debug("relay(): msid=%d reply_msid=%r", msid, reply_msid)
+	logging.debug("relay", extra={"msid": msid, "uid": user.id, "reply_msid": reply_msid})
 	ch.saveMapping(user.id, msid, ev.message_id)
 
 	for user2 in db.iterateUsers():
@@ -1189,9 +1932,6 @@ def relay_inner(ev, *, caption_text=None, expose=False, signed=False, tripcode=F
 		if mute and user.rank < RANKS.admin: # test if only admins see this person's messages.
 			logging.info(f"{user2} saw message from {user}!")
 
-		# Stub mapping so that instant sends can be told that there is an EXPECTED msid involved, even if there's none now.
-		# Fix: some places should probably check if msid is -1 and throw a "not found" anyway.
-		ch.saveMapping(user2.id, msid, -1)
 		send_to_single(ev_tosend, msid, user2,
 			reply_msid=reply_msid, force_caption=force_caption)
 
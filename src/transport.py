@@ -0,0 +1,112 @@
+import asyncio
+import logging
+from threading import Thread, BoundedSemaphore
+
+try:
+	import aiohttp
+except ImportError:
+	aiohttp = None
+
+# Bot API error, `error_code` is None if the request did not get through at all
+class ApiError(Exception):
+	def __init__(self, method, error_code, description, retry_after=None):
+		super(ApiError, self).__init__("%s: %s" % (method, description))
+		self.method = method
+		self.error_code = error_code
+		self.description = description
+		self.retry_after = retry_after
+
+# asyncio Bot API client: runs its own event loop in a background thread and
+# keeps a small pool of keep-alive connections that all calls share
+# `rate` is the AIMDRate that paces calls and learns from the responses
+class AsyncTransport():
+	def __init__(self, token, base_url, rate, connections=8, in_flight=32, timeout=20):
+		if aiohttp is None:
+			raise RuntimeError("the async transport needs aiohttp")
+		self.url = "%s/bot%s/" % (base_url.rstrip("/"), token)
+		self.rate = rate
+		self.connections = connections
+		self.timeout = timeout
+		self.submitted = BoundedSemaphore(in_flight * 8) # limits calls submitted but not done
+		self.slots = asyncio.Semaphore(in_flight) # limits calls in flight, only used on the loop
+		self.loop = asyncio.new_event_loop()
+		self.session = None
+		self.chains = {} # key -> (asyncio.Lock, calls waiting or running), only used on the loop
+	def start(self):
+		t = Thread(target=self._run)
+		t.daemon = True
+		t.start()
+		asyncio.run_coroutine_threadsafe(self._open(), self.loop).result()
+	def close(self):
+		if self.session is not None:
+			asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+	def _run(self):
+		asyncio.set_event_loop(self.loop)
+		self.loop.run_forever()
+	async def _open(self):
+		connector = aiohttp.TCPConnector(limit=self.connections, keepalive_timeout=60)
+		timeout = aiohttp.ClientTimeout(total=self.timeout)
+		self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+	# perform Bot API call `method`, returns its result or raises ApiError
+	async def call(self, method, **params):
+		params = {k: v for k, v in params.items() if v is not None}
+		try:
+			async with self.session.post(self.url + method, json=params) as resp:
+				result = await resp.json(content_type=None)
+		except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+			raise ApiError(method, None, "%s: %s" % (type(e).__name__, e))
+		if not result.get("ok"):
+			retry_after = result.get("parameters", {}).get("retry_after")
+			if result.get("error_code") == 429:
+				self.rate.throttled(retry_after or 0)
+			raise ApiError(method, result.get("error_code"), result.get("description", ""), retry_after)
+		self.rate.success()
+		return result["result"]
+	# schedule coroutine function `func` on the event loop without waiting for it,
+	# blocks while too many calls were submitted and haven't finished yet
+	# funcs with the same `key` (e.g. a chat id) run one after another, in order
+	def submit(self, func, key=None):
+		self.submitted.acquire()
+		fut = asyncio.run_coroutine_threadsafe(self._chained(func, key), self.loop)
+		fut.add_done_callback(self._done)
+		return fut
+	async def _chained(self, func, key):
+		if key is None:
+			return await self._call(func)
+		lock, n = self.chains.get(key, (None, 0))
+		if lock is None:
+			lock = asyncio.Lock() # grants the lock in the order it was asked for
+		self.chains[key] = (lock, n + 1)
+		try:
+			async with lock:
+				return await self._call(func)
+		finally:
+			lock, n = self.chains[key]
+			if n == 1:
+				del self.chains[key]
+			else:
+				self.chains[key] = (lock, n - 1)
+	# the in-flight slot is only taken once it's the call's turn in its chain,
+	# so calls waiting behind a slow chat don't hold up the others
+	async def _call(self, func):
+		async with self.slots:
+			await asyncio.sleep(self.rate.reserve())
+			return await func()
+	# for retries inside a submitted func: sleep `seconds`, then wait for the
+	# send rate like the first attempt does
+	async def backoff(self, seconds):
+		await asyncio.sleep(seconds)
+		await asyncio.sleep(self.rate.reserve())
+	# wait up to `timeout` seconds for the calls in flight to finish
+	def flush(self, timeout):
+		async def wait():
+			tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+			await asyncio.gather(*tasks, return_exceptions=True)
+		try:
+			asyncio.run_coroutine_threadsafe(wait(), self.loop).result(timeout)
+		except TimeoutError:
+			pass
+	def _done(self, fut):
+		self.submitted.release()
+		if not fut.cancelled() and fut.exception() is not None:
+			logging.error("Exception raised during queued message", exc_info=fut.exception())
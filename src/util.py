@@ -1,63 +1,417 @@
 import itertools
 import time
+import random
 import logging
-from queue import PriorityQueue
-from threading import Lock
+import heapq
+import json
+import hashlib
+import base64
+from queue import Queue
+from logging.handlers import QueueHandler
+from collections import deque, OrderedDict
+from threading import Lock, Condition, Thread
 from datetime import timedelta
-from passlib.hash import pbkdf2_sha512
 
+class ScheduledTask():
+	__slots__ = ("name", "func", "interval", "jitter", "due", "running", "cancelled")
+	def __init__(self, name, func, interval, jitter):
+		self.name = name
+		self.func = func
+		self.interval = interval # seconds
+		self.jitter = jitter # up to this many seconds are added to every deadline
+		self.due = None # next deadline, without jitter
+		self.running = False
+		self.cancelled = False
+	def cancel(self):
+		self.cancelled = True
+
+# Runs tasks periodically on a small pool of worker threads. A task that is
+# still running when it is due again skips that run instead of overlapping.
+# Run duration and lag (how late a run started) are published to `metrics`.
 class Scheduler():
-	def __init__(self):
-		self.tasks = [] # list of [interval, next_trigger, func]
-	@staticmethod
-	def _wrapped_call(f):
-		try:
-			f()
-		except Exception as e:
-			logging.exception("Exception raised during scheduled task")
-	def register(self, func, **kwargs):
-		interval = timedelta(**kwargs) // timedelta(seconds=1)
+	def __init__(self, workers=2, metrics=None):
+		self.heap = [] # contains (deadline, seq, ScheduledTask)
+		self.counter = itertools.count()
+		self.cond = Condition()
+		self.jobs = Queue() # contains (ScheduledTask, deadline)
+		self.workers = workers
+		self.metrics = metrics
+	def _worker(self):
+		while True:
+			task, deadline = self.jobs.get()
+			start = time.monotonic()
+			try:
+				task.func()
+			except Exception as e:
+				logging.exception("Exception raised during scheduled task")
+			task.running = False
+			if self.metrics is not None:
+				self.metrics.set("task_%s_lag" % task.name, start - deadline)
+				self.metrics.set("task_%s_duration" % task.name, time.monotonic() - start)
+	def _push(self, task):
+		deadline = task.due + random.uniform(0, task.jitter)
+		heapq.heappush(self.heap, (deadline, next(self.counter), task))
+		self.cond.notify()
+	# returns the ScheduledTask, which can be used to cancel it
+	def register(self, func, name=None, jitter=0, **kwargs):
+		interval = timedelta(**kwargs).total_seconds()
 		assert interval > 0
-		self.tasks.append([interval, 0, func])
+		task = ScheduledTask(name or func.__name__, func, interval, jitter)
+		with self.cond:
+			task.due = time.monotonic() # first run right away
+			self._push(task)
+		return task
 	def run(self):
-		while True:
-			# Run tasks that have expired
-			now = int(time.monotonic())
-			for e in self.tasks:
-				if now >= e[1]:
-					Scheduler._wrapped_call(e[2])
-					e[1] = now + e[0]
-			# Wait until a task expires
-			now = int(time.monotonic())
-			wait = min((e[1] - now) for e in self.tasks)
-			if wait > 0:
-				time.sleep(wait)
+		for i in range(self.workers):
+			t = Thread(target=self._worker)
+			t.daemon = True
+			t.start()
+		with self.cond:
+			while True:
+				if len(self.heap) == 0:
+					self.cond.wait()
+					continue
+				deadline, _, task = self.heap[0]
+				now = time.monotonic()
+				if deadline > now:
+					self.cond.wait(deadline - now)
+					continue
+				heapq.heappop(self.heap)
+				if task.cancelled:
+					continue
+				if task.running:
+					if self.metrics is not None:
+						self.metrics.inc("task_%s_skipped" % task.name)
+				else:
+					task.running = True
+					self.jobs.put((task, deadline))
+				# keep the cadence, but don't try to make up for missed runs
+				task.due = max(task.due + task.interval, now)
+				self._push(task)
 
+class QueueLane():
+	__slots__ = ("weight", "flows", "active", "size", "credit")
+	def __init__(self, weight):
+		assert weight > 0
+		self.weight = weight
+		self.flows = {} # flow key -> heap of (prio, iid), including deleted entries
+		self.active = deque() # keys of non-empty flows in round-robin order
+		self.size = 0 # number of entries that weren't deleted
+		self.credit = 0
+
+# `lanes` maps lane names to weights: items are taken from the non-empty lanes
+# in proportion to their weights (smooth weighted round-robin)
+# within a lane, items are split into flows by the `flow` func: flows take
+# turns (round-robin) and each flow is ordered by priority
 class MutablePriorityQueue():
-	def __init__(self):
-		self.queue = PriorityQueue() # contains (prio, iid)
+	# `indexes` maps names to funcs that return the key of an item in that index,
+	# items can then be found by key without scanning (None keys aren't indexed)
+	def __init__(self, lanes=None, flow=None, **indexes):
+		self.lanes = {name: QueueLane(w) for name, w in (lanes or {None: 1}).items()}
+		self.flow = flow or (lambda data: None)
 		self.items = {} # maps iid -> opaque
+		self.lane_of = {} # maps iid -> lane name
+		self.keyfuncs = indexes
+		self.indexes = {name: {} for name in indexes.keys()} # name -> dict(key -> dict(iid -> None)) in insertion order
+		self.keys = {} # maps iid -> dict(name -> key)
 		self.counter = itertools.count()
-		# protects `items` and `counter`, `queue` has its own lock
+		self.taken = 0 # items returned by get() that weren't marked done yet
 		self.lock = Lock()
+		self.nonempty = Condition(self.lock)
+	def _remove(self, iid):
+		data = self.items.pop(iid)
+		lane = self.lanes[self.lane_of.pop(iid)]
+		lane.size -= 1
+		if lane.size == 0:
+			# only deleted entries left
+			lane.flows.clear()
+			lane.active.clear()
+		for name, k in self.keys.pop(iid).items():
+			index = self.indexes[name]
+			del index[k][iid]
+			if len(index[k]) == 0:
+				del index[k]
+		return data
+	def _pickLane(self):
+		best, total = None, 0
+		for lane in self.lanes.values():
+			if lane.size == 0:
+				continue
+			lane.credit += lane.weight
+			total += lane.weight
+			if best is None or lane.credit > best.credit:
+				best = lane
+		if best is not None:
+			best.credit -= total
+		return best
 	def get(self):
-		while True:
-			_, iid = self.queue.get()
-			with self.lock:
+		with self.lock:
+			while True:
+				lane = self._pickLane()
+				if lane is not None:
+					break
+				self.nonempty.wait()
+			while True:
+				k = lane.active[0]
+				heap = lane.flows[k]
+				_, iid = heapq.heappop(heap)
+				lane.active.popleft()
+				if len(heap) == 0:
+					del lane.flows[k]
+				elif iid in self.items.keys():
+					lane.active.append(k) # next flow's turn
+				else:
+					lane.active.appendleft(k)
 				# skip deleted entries
 				if iid in self.items.keys():
-					return self.items.pop(iid)
-	def put(self, prio, data):
+					self.taken += 1
+					return self._remove(iid)
+	# mark an item returned by get() as handled
+	def task_done(self):
+		with self.lock:
+			self.taken -= 1
+	# number of items that are queued or taken but not handled yet
+	def unfinished(self):
 		with self.lock:
+			return len(self.items) + self.taken
+	# `merge(last, n)` is called with the last pending item that has the same key
+	# in index `group` and the number of such items, it returns True if `data`
+	# was merged into `last` and thus doesn't need to be queued itself
+	def put(self, prio, data, merge=None, group=None, lane=None):
+		with self.lock:
+			keys = {}
+			for name, func in self.keyfuncs.items():
+				k = func(data)
+				if k is not None:
+					keys[name] = k
+			if merge is not None and group in keys.keys():
+				pending = self.indexes[group].get(keys[group])
+				if pending and merge(self.items[next(reversed(pending))], len(pending)):
+					return
 			iid = next(self.counter)
 			self.items[iid] = data
-		self.queue.put((prio, iid))
-	def delete(self, selector):
+			self.lane_of[iid] = lane
+			self.keys[iid] = keys
+			for name, k in keys.items():
+				self.indexes[name].setdefault(k, {})[iid] = None
+			lane = self.lanes[lane]
+			k = self.flow(data)
+			if k not in lane.flows.keys():
+				lane.flows[k] = []
+				lane.active.append(k)
+			heapq.heappush(lane.flows[k], (prio, iid))
+			lane.size += 1
+			self.nonempty.notify()
+	# remove and return all items, in the order they were put
+	def clear(self):
+		with self.lock:
+			return [self._remove(iid) for iid in list(self.items.keys())]
+	def __len__(self):
+		return len(self.items)
+	# delete all items with key `key` in index `name`, returns how many there were
+	def deleteBy(self, name, key):
+		with self.lock:
+			iids = list(self.indexes[name].get(key, {}).keys())
+			for iid in iids:
+				self._remove(iid)
+		return len(iids)
+
+class KeyedWorkerPool():
+	def __init__(self, n):
+		assert n > 0
+		self.queues = [Queue() for i in range(n)] # one per worker, contains funcs
+	def start(self):
+		for q in self.queues:
+			t = Thread(target=KeyedWorkerPool._worker, args=(q, ))
+			t.daemon = True
+			t.start()
+	@staticmethod
+	def _worker(q):
+		while True:
+			f = q.get()
+			try:
+				f()
+			except Exception as e:
+				logging.exception("Exception raised in worker")
+	# funcs submitted with the same key run on the same worker, in order
+	def submit(self, key, func):
+		self.queues[hash(key) % len(self.queues)].put(func)
+
+# Send rate that grows additively while calls succeed and is cut
+# multiplicatively when Telegram answers with 429 (AIMD)
+class AIMDRate():
+	def __init__(self, rate, floor, ceiling, increase=1, decrease=0.5):
+		assert 0 < floor <= ceiling
+		self.lock = Lock()
+		self.rate = min(max(rate, floor), ceiling) # calls per second
+		self.floor = floor
+		self.ceiling = ceiling
+		self.increase = increase # calls per second gained per second of successes
+		self.decrease = decrease
+		self.next_call = 0 # monotonic time the next call may start
+		self.cut_until = 0 # ignore further 429s from calls made before the cut
+	# claim the next call slot, returns the seconds until it starts
+	def reserve(self):
+		with self.lock:
+			now = time.monotonic()
+			start = max(self.next_call, now)
+			self.next_call = start + 1 / self.rate
+		return start - now
+	# block until the next call may start
+	def wait(self):
+		d = self.reserve()
+		if d > 0:
+			time.sleep(d)
+	def success(self):
+		with self.lock:
+			self.rate = min(self.ceiling, self.rate + self.increase / self.rate)
+	# `pause` is the retry_after Telegram asked for, in seconds
+	def throttled(self, pause=0):
+		with self.lock:
+			now = time.monotonic()
+			self.next_call = max(self.next_call, now + pause)
+			if now < self.cut_until:
+				return
+			self.rate = max(self.floor, self.rate * self.decrease)
+			self.cut_until = now + pause + 1
+			rate = self.rate
+		logging.warning("Send rate lowered to %.1f/s", rate)
+
+# Per-key circuit breaker: after `threshold` consecutive failures the key is
+# open for `cooldown` seconds, then a single call may probe it (half-open)
+class CircuitBreaker():
+	def __init__(self, threshold, cooldown):
+		assert threshold > 0
+		self.lock = Lock()
+		self.threshold = threshold
+		self.cooldown = cooldown
+		self.failures = {} # key -> consecutive failures
+		self.open_until = {} # key -> monotonic time a probe is allowed
+		self.probing = set() # keys with a probe in progress
+	# returns whether a call for `key` should be made
+	def allow(self, key):
+		with self.lock:
+			until = self.open_until.get(key)
+			if until is None:
+				return True
+			if key in self.probing or time.monotonic() < until:
+				return False
+			self.probing.add(key)
+			return True
+	def success(self, key):
+		with self.lock:
+			self.failures.pop(key, None)
+			if self.open_until.pop(key, None) is not None:
+				logging.info("Circuit for %r closed again", key)
+			self.probing.discard(key)
+	# returns True if the circuit for `key` is open now
+	def failure(self, key):
+		with self.lock:
+			n = self.failures.get(key, 0) + 1
+			self.failures[key] = n
+			self.probing.discard(key)
+			if n < self.threshold:
+				return False
+			if key not in self.open_until:
+				logging.warning("Circuit for %r opened after %d failures", key, n)
+			self.open_until[key] = time.monotonic() + self.cooldown
+			return True
+	# ends a probe that neither succeeded nor failed (e.g. the message was bad),
+	# so that the next call may probe again
+	def release(self, key):
+		with self.lock:
+			self.probing.discard(key)
+	def openCount(self):
+		with self.lock:
+			return len(self.open_until)
+
+# map whose entries expire `ttl` seconds after they were last set, holding at
+# most `maxsize` of them (the oldest are evicted first)
+# expired entries are dropped lazily on access, counters go to `metrics` if given
+class TTLMap():
+	def __init__(self, ttl, maxsize, name=None, metrics=None):
+		assert maxsize > 0
+		self.lock = Lock()
+		self.ttl = ttl
+		self.maxsize = maxsize
+		self.name = name
+		self.metrics = metrics
+		self.items = OrderedDict() # key -> (monotonic expiry, value), oldest first
+	def _count(self, what, n=1):
+		if self.metrics is not None and n > 0:
+			self.metrics.inc("%s_%s" % (self.name, what), n)
+	def _expire(self, now):
+		n = 0
+		while len(self.items) > 0:
+			key, (expiry, _) = next(iter(self.items.items()))
+			if expiry > now:
+				break
+			del self.items[key]
+			n += 1
+		self._count("expired", n)
+	def get(self, key, default=None):
+		with self.lock:
+			entry = self.items.get(key)
+			if entry is not None and entry[0] <= time.monotonic():
+				del self.items[key]
+				self._count("expired")
+				entry = None
+			self._count("misses" if entry is None else "hits")
+			return default if entry is None else entry[1]
+	def __setitem__(self, key, value):
+		now = time.monotonic()
+		with self.lock:
+			self.items.pop(key, None)
+			self.items[key] = (now + self.ttl, value)
+			self._expire(now)
+			n = 0
+			while len(self.items) > self.maxsize:
+				self.items.popitem(last=False)
+				n += 1
+			self._count("evicted", n)
+	def __len__(self):
+		with self.lock:
+			self._expire(time.monotonic())
+			return len(self.items)
+
+# Appends the fields passed to a logging call as `extra` in key=value form
+class KeyValueFormatter(logging.Formatter):
+	RESERVED = set(vars(logging.makeLogRecord({})).keys()) | {"message", "asctime"}
+	def formatMessage(self, record):
+		s = super(KeyValueFormatter, self).formatMessage(record)
+		for k, v in vars(record).items():
+			if k in KeyValueFormatter.RESERVED:
+				continue
+			if isinstance(v, float):
+				v = "%.3f" % v
+			elif isinstance(v, str) and (v == "" or " " in v or "=" in v):
+				v = json.dumps(v)
+			s += " %s=%s" % (k, v)
+		return s
+
+# QueueHandler that leaves formatting to the listener thread, note that
+# arguments to logging calls are thus formatted after the call returned
+class DeferredQueueHandler(QueueHandler):
+	def prepare(self, record):
+		return record
+
+class Metrics():
+	def __init__(self):
+		self.lock = Lock()
+		self.values = {} # name -> number or function returning one
+	def set(self, name, value):
+		with self.lock:
+			self.values[name] = value
+	def inc(self, name, n=1):
+		with self.lock:
+			self.values[name] = self.values.get(name, 0) + n
+	# `func` is called to get the current value whenever it is read
+	def gauge(self, name, func):
+		self.set(name, func)
+	def snapshot(self):
 		with self.lock:
-			keys = list(self.items.keys())
-			for iid in keys:
-				if selector(self.items[iid]):
-					del self.items[iid]
+			l = sorted(self.values.items())
+		return {k: (v() if callable(v) else v) for k, v in l}
 
 class Enum():
 	def __init__(self, m, reverse=True):
@@ -85,17 +439,20 @@ def _salt(c):
 	return '.'
 
 def genTripcode(tripcode, salt):
-    pos = tripcode.find("#")
-    trname = tripcode[:pos]
-    trpass = tripcode[pos + 1:]
+	pos = tripcode.find("#")
+	trname = tripcode[:pos]
+	trpass = tripcode[pos + 1:]
 
-    salt = (trpass[:8] + 'H.')[1:3]
-    salt = "".join(_salt(c) for c in salt)
-    salt = salt.encode('utf-8')  # Convert salt to bytes
+	salt = (trpass[:8] + 'H.')[1:3]
+	salt = "".join(_salt(c) for c in salt)
+	salt = salt.encode('utf-8')  # Convert salt to bytes
 
-    # Here we use the passlib.pbkdf2_sha512 with the salt
-    trip_final = pbkdf2_sha512.hash(trpass[:8], salt=salt, rounds=1)
-    for x in range(0, 9937):
-        trip_final = pbkdf2_sha512.hash(trip_final[:8], salt=salt, rounds=1)
+	# Tripcodes used to be derived by hashing the secret with passlib's
+	# pbkdf2_sha512 and then re-hashing the first 8 chars of the resulting hash
+	# string 9937 times. Those are always "$pbkdf2-", so only the last round
+	# mattered, and only the two salt characters of the secret affect it.
+	# This computes that round directly, with identical results.
+	digest = hashlib.pbkdf2_hmac("sha512", b"$pbkdf2-", salt, 1)
+	trip_final = base64.b64encode(digest).decode("ascii").rstrip("=").replace("+", ".")
 
-    return trname, "!" + trip_final[-10:]
+	return trname, "!" + trip_final[-10:]
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+import sys
+import os
+import random
+import string
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from src.util import genTripcode, _salt
+
+# tripcodes generated by the passlib implementation
+KNOWN = {
+	"name#secret": "!ff3pL5oXpQ",
+	"a#b": "!cEwpzghvrA",
+	"anon#x1": "!GZq5kI5igw",
+	"User#password123": "!soQk06viNQ",
+	"tr#:@[`": "!yz/BSFL9Lg",
+	"x#ÄÖÜ": "!04IHKPohaQ",
+	"日本#語テスト": "!04IHKPohaQ",
+	"n#  ": "!K6fEJ5z06Q",
+	"Mod#hunter2": "!RtzlpFqWsQ",
+	"z#.Z": "!1.OVFLbDUg",
+	"q#AZaz09": "!.wtnHJ6IWg",
+}
+
+# the implementation genTripcode replaced (needs passlib)
+def genTripcodePasslib(tripcode):
+	from passlib.hash import pbkdf2_sha512
+	pos = tripcode.find("#")
+	trname = tripcode[:pos]
+	trpass = tripcode[pos + 1:]
+	salt = (trpass[:8] + 'H.')[1:3]
+	salt = "".join(_salt(c) for c in salt).encode('utf-8')
+	trip_final = pbkdf2_sha512.hash(trpass[:8], salt=salt, rounds=1)
+	for x in range(0, 9937):
+		trip_final = pbkdf2_sha512.hash(trip_final[:8], salt=salt, rounds=1)
+	return trname, "!" + trip_final[-10:]
+
+def random_tripcode():
+	chars = string.ascii_letters + string.digits + string.punctuation.replace("#", "")
+	secret = "".join(random.choice(chars) for i in range(random.randint(1, 12)))
+	return "name#" + secret
+
+def main(argv):
+	n = int(argv[0]) if len(argv) > 0 else 20
+
+	for tripcode, triphash in KNOWN.items():
+		if genTripcode(tripcode, None)[1] != triphash:
+			print("MISMATCH for %r" % tripcode)
+			exit(1)
+	print("%d known tripcodes match" % len(KNOWN))
+
+	try:
+		import passlib
+	except ImportError:
+		print("passlib not installed, can't compare with the old implementation")
+		exit(0)
+	corpus = [random_tripcode() for i in range(n)]
+	for tripcode in corpus:
+		if genTripcode(tripcode, None) != genTripcodePasslib(tripcode):
+			print("MISMATCH for %r" % tripcode)
+			exit(1)
+	print("%d random tripcodes match" % n)
+
+	old = timeit.timeit(lambda: [genTripcodePasslib(t) for t in corpus], number=1) / n
+	new = min(timeit.repeat(lambda: [genTripcode(t, None) for t in corpus], number=100, repeat=5)) / (100 * n)
+	print("passlib:  %10.3f ms per call" % (old * 1000))
+	print("hashlib:  %10.3f ms per call" % (new * 1000))
+	print("speedup:  %10.0fx" % (old / new))
+
+if __name__ == "__main__":
+	main(sys.argv[1:])